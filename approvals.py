@@ -0,0 +1,207 @@
+"""
+Bulk approval engine for pending join requests.
+
+Approvals run on a pool of workers (APPROVAL_CONCURRENCY) that share a token
+bucket (APPROVAL_RATE / APPROVAL_BURST). A RetryAfter from Telegram pauses
+the whole pipeline for the requested time and the user is retried, instead
+of being counted as failed. Users that still fail with a transient error are
+handed to the durable retry queue (retries.py) rather than dropped.
+"""
+
+import asyncio
+import logging
+import weakref
+from dataclasses import dataclass
+
+from telegram.error import RetryAfter, TelegramError
+
+import async_db as db
+import cache
+from config import (
+    APPROVAL_RATE, APPROVAL_BURST, APPROVAL_CONCURRENCY, APPROVAL_MAX_RETRIES, JOB_BATCH_SIZE
+)
+from ingest import flush_chat
+from ratelimit import TokenBucket, is_transient, retry_after_seconds
+from retries import retry_queue
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ApprovalStats:
+    """Counters for an approval run"""
+    accepted: int = 0
+    failed: int = 0
+    retried: int = 0
+    deferred: int = 0   # handed to the retry queue
+
+    def add(self, other):
+        self.accepted += other.accepted
+        self.failed += other.failed
+        self.retried += other.retried
+        self.deferred += other.deferred
+
+
+class ApprovalEngine:
+    """Approves join requests with bounded concurrency under a shared rate limit"""
+
+    def __init__(self, bot, rate=APPROVAL_RATE, burst=APPROVAL_BURST,
+                 concurrency=APPROVAL_CONCURRENCY, max_retries=APPROVAL_MAX_RETRIES, bucket=None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        # bucket: e.g. a SharedTokenBucket, instead of one built from rate/burst
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._paused_until = 0.0
+
+    async def _pause(self, seconds):
+        """Stop every worker until the flood wait is over"""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        self._resume.clear()
+        logger.warning("Flood control hit, pausing approvals for %.1fs", seconds)
+        while (remaining := self._paused_until - loop.time()) > 0:
+            await asyncio.sleep(remaining)
+        self._resume.set()
+
+    async def approve_one(self, chat_id, user_id, stats):
+        """Approve a single user, retrying flood waits and transient errors
+
+        Returns None on success, or the error the user finally failed with.
+        """
+        attempts = 0
+        while True:
+            await self._resume.wait()
+            await self.bucket.acquire()
+            try:
+                await self.bot.approve_chat_join_request(chat_id, user_id)
+                stats.accepted += 1
+                return None
+            except RetryAfter as e:
+                stats.retried += 1
+                await self._pause(retry_after_seconds(e))
+            except TelegramError as e:
+                if is_transient(e) and attempts < self.max_retries:
+                    attempts += 1
+                    stats.retried += 1
+                    await asyncio.sleep(min(2 ** attempts, 30))
+                    continue
+                stats.failed += 1
+                return e
+
+    async def approve_many(self, chat_id, user_ids, failures=None):
+        """Approve all `user_ids` and return the run's ApprovalStats
+
+        failures: optional dict filled with user_id -> error for every user that failed
+        """
+        stats = ApprovalStats()
+        users = iter(user_ids)
+        lost_rights = False
+
+        async def worker():
+            nonlocal lost_rights
+            for user_id in users:
+                error = await self.approve_one(chat_id, user_id, stats)
+                if error is not None:
+                    lost_rights = lost_rights or cache.is_permission_error(error)
+                    if failures is not None:
+                        failures[user_id] = error
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        if lost_rights:
+            # Once per run, not per refused user: the cached admin status is stale
+            cache.invalidate(chat_id)
+        return stats
+
+
+_engines = weakref.WeakKeyDictionary()
+
+
+def get_engine(bot):
+    """Return the shared engine for a bot so every run uses the same rate limit"""
+    engine = _engines.get(bot)
+    if engine is None:
+        engine = _engines[bot] = ApprovalEngine(bot)
+    return engine
+
+
+def configure_engine(bot, **kwargs):
+    """Replace a bot's shared engine, e.g. with a different rate or concurrency"""
+    engine = _engines[bot] = ApprovalEngine(bot, **kwargs)
+    return engine
+
+
+async def _approve_batch(engine, chat_id, requests):
+    """Approve pending requests and remove them from the backlog; returns ApprovalStats"""
+    user_ids = [req['user_id'] for req in requests]
+    failures = {}
+    batch = await engine.approve_many(chat_id, user_ids, failures)
+    # Transient failures are retried later instead of being lost with the batch
+    deferred = set()
+    for req in requests:
+        error = failures.get(req['user_id'])
+        if error is not None and is_transient(error):
+            await retry_queue.defer(chat_id, req['user_id'], req['first_name'],
+                                    req['username'], error)
+            deferred.add(req['user_id'])
+            batch.failed -= 1
+            batch.deferred += 1
+
+    # Accepted, failed and deferred requests all leave the backlog: one commit per batch,
+    # once the deferred ones are safely in approval_retries
+    if deferred and not await retry_queue.flush():
+        # Not recorded for a retry: keep them pending for a later run instead of losing them
+        logger.error("Keeping %d deferred approvals in %s pending", len(deferred), chat_id)
+        user_ids = [user_id for user_id in user_ids if user_id not in deferred]
+        batch.deferred -= len(deferred)
+    await db.delete_pending_requests(chat_id, user_ids)
+    return batch
+
+
+async def drain_pending(bot, chat_id, count=None, batch_size=JOB_BATCH_SIZE,
+                        on_batch=None, should_stop=None, turn=None):
+    """Approve up to `count` pending requests of a chat (all when None), batch by batch
+
+    `on_batch(batch_stats, processed)` is awaited after each batch has been approved
+    and removed from pending_requests; `should_stop()` is checked between batches.
+    `turn(wanted)`, when given, is an async context manager that waits for the
+    caller's turn and yields how many requests the next batch may hold
+    (scheduler.FairScheduler.turn).
+    """
+    # Make sure buffered join requests are visible before reading
+    await flush_chat(chat_id)
+    if count is None:
+        count = await db.get_pending_count(chat_id)
+
+    engine = get_engine(bot)
+    stats = ApprovalStats()
+    processed = 0
+    if count <= 0:
+        return stats
+
+    # Stream the backlog in fixed-size chunks so memory does not grow with it
+    async for chunk in db.iter_pending_requests(chat_id, batch_size):
+        requests = chunk[:count - processed]
+        while requests:
+            if should_stop is not None and should_stop():
+                return stats
+            if turn is None:
+                size = len(requests)
+                batch = await _approve_batch(engine, chat_id, requests)
+            else:
+                async with turn(len(requests)) as size:
+                    # The wait may have been long: do not use a turn after a cancel
+                    if should_stop is not None and should_stop():
+                        return stats
+                    batch = await _approve_batch(engine, chat_id, requests[:size])
+            requests = requests[size:]
+
+            stats.add(batch)
+            processed += size
+            if on_batch is not None:
+                await on_batch(batch, processed)
+        if processed >= count:
+            break
+    return stats
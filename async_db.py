@@ -0,0 +1,145 @@
+"""
+Async access to database.py for the bot handlers.
+
+Every query runs on a single dedicated DB thread that owns the shared SQLite
+connection, so handlers never block the event loop on disk I/O. Users,
+channels and pending requests go to the configured storage backend
+(storage.py); approval jobs and retries always use database.py.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import database
+import metrics
+from storage import get_storage
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """Run a storage or database.py function on the DB thread (timed into metrics.DB_SECONDS)"""
+    loop = asyncio.get_running_loop()
+    call = partial(metrics.timed_call, func.__name__, func, *args, **kwargs)
+    return await loop.run_in_executor(_executor, call)
+
+
+async def call(func, *args):
+    """Run any callable on the DB thread without timing it as a query"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+
+def shutdown():
+    """Wait for queued queries, then close the storage and the connection"""
+    _executor.shutdown(wait=True)
+    get_storage().close()
+    database.close_connection()
+
+
+def is_auto_accept(chat_id):
+    """In-memory lookup, no DB thread hop needed"""
+    return get_storage().is_auto_accept(chat_id)
+
+
+async def init_db():
+    return await run(database.init_db)
+
+async def add_user(user_id, username, first_name):
+    return await run(get_storage().add_user, user_id, username, first_name)
+
+async def add_channel(user_id, chat_id, title, chat_type):
+    return await run(get_storage().add_channel, user_id, chat_id, title, chat_type)
+
+async def get_user_channels(user_id, limit=-1, offset=0):
+    return await run(get_storage().get_user_channels, user_id, limit, offset)
+
+async def get_channel(user_id, chat_id):
+    return await run(get_storage().get_channel, user_id, chat_id)
+
+async def delete_channel(user_id, chat_id):
+    return await run(get_storage().delete_channel, user_id, chat_id)
+
+async def toggle_auto_accept(user_id, chat_id):
+    return await run(get_storage().toggle_auto_accept, user_id, chat_id)
+
+async def get_auto_accept_channels():
+    return await run(get_storage().get_auto_accept_channels)
+
+async def refresh_auto_accept_index():
+    return await run(get_storage().refresh_auto_accept_index)
+
+async def add_pending_request(chat_id, user_id, first_name, username):
+    return await run(get_storage().add_pending_request, chat_id, user_id, first_name, username)
+
+async def add_pending_requests(rows):
+    return await run(get_storage().add_pending_requests, rows)
+
+async def get_pending_requests(chat_id, limit=None):
+    return await run(get_storage().get_pending_requests, chat_id, limit)
+
+async def get_pending_page(chat_id, limit, after=None):
+    return await run(get_storage().get_pending_page, chat_id, limit, after)
+
+async def iter_pending_requests(chat_id, chunk_size=500):
+    """Async stream of pending request chunks; one DB round trip per chunk"""
+    after = None
+    while True:
+        chunk = await get_pending_page(chat_id, chunk_size, after)
+        if not chunk:
+            return
+        yield chunk
+        after = (chunk[-1]['created_at'], chunk[-1]['id'])
+
+async def delete_pending_request(chat_id, user_id):
+    return await run(get_storage().delete_pending_request, chat_id, user_id)
+
+async def delete_pending_requests(chat_id, user_ids):
+    return await run(get_storage().delete_pending_requests, chat_id, user_ids)
+
+async def get_pending_count(chat_id):
+    return await run(get_storage().get_pending_count, chat_id)
+
+async def expire_pending_requests(max_age_seconds, limit):
+    return await run(get_storage().expire_pending_requests, max_age_seconds, limit)
+
+async def incremental_vacuum(pages=0):
+    return await run(database.incremental_vacuum, pages)
+
+async def schedule_approval_retries(rows):
+    return await run(database.schedule_approval_retries, rows)
+
+async def get_due_approval_retries(now, limit):
+    return await run(database.get_due_approval_retries, now, limit)
+
+async def delete_approval_retries(keys):
+    return await run(database.delete_approval_retries, keys)
+
+async def move_approval_retries_to_pending(rows):
+    """Store given-up retries as pending requests, then drop them from the retry queue
+
+    Returns False, leaving the retries queued, if the pending requests could not be written.
+    """
+    rows = list(rows)
+    if not await run(get_storage().add_pending_requests, rows):
+        return False
+    await run(database.delete_approval_retries, [(chat_id, user_id) for chat_id, user_id, _, _ in rows])
+    return True
+
+async def get_approval_retry_count():
+    return await run(database.get_approval_retry_count)
+
+async def create_approval_job(owner_id, chat_id, requested, message_chat_id, message_id):
+    return await run(database.create_approval_job, owner_id, chat_id, requested,
+                     message_chat_id, message_id)
+
+async def update_approval_job(job_id, processed, accepted, failed, retried, status=None):
+    return await run(database.update_approval_job, job_id, processed, accepted, failed,
+                     retried, status)
+
+async def get_approval_job(job_id):
+    return await run(database.get_approval_job, job_id)
+
+async def get_running_approval_jobs():
+    return await run(database.get_running_approval_jobs)
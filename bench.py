@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite.
+
+Drives the real handlers with synthetic updates against harness.FakeBotAPI
+(configurable latency, error rate and RetryAfter injection) and a throwaway
+bot_data.db, then reports throughput, p50/p99 handler latency and the time
+spent in each storage and database.py function.
+
+    python bench.py                                   # all scenarios, default sizes
+    python bench.py join_flood --count 50000
+    python bench.py accept_all --count 100000 --latency 0.005 --retry-after-rate 0.001
+    python bench.py --storage memory                  # users/channels/pending in memory
+    python bench.py ordering                          # concurrency of the update processor
+
+The API rate governor and the approval engine's token bucket are off unless
+--rate-limit is given, so the numbers show the bot's own overhead.
+"""
+
+import argparse
+import asyncio
+import functools
+import logging
+import time
+
+from telegram import Update
+
+import approvals
+import bot
+import callbacks
+import database
+import handlers
+import harness
+from storage import SQLiteStorage, Storage, get_storage
+
+OWNER_ID = 1
+CHAT_ID = -1001000000001
+AUTO_CHAT_ID = -1001000000002
+FIRST_USER_ID = 10_000_000
+
+# database.py functions that are not queries (or are generators)
+_NOT_TIMED = {"get_connection", "close_connection", "is_auto_accept", "iter_pending_requests",
+              "init_db", "open", "close"}
+
+_db_times = {}
+_handler_errors = {}
+
+
+async def _count_error(update, context):
+    name = type(context.error).__name__
+    _handler_errors[name] = _handler_errors.get(name, 0) + 1
+
+
+def _timed(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _db_times.setdefault(name, []).append(time.perf_counter() - started)
+    return wrapper
+
+
+def instrument_database():
+    """Time every query function in database.py (async_db looks them up per call)"""
+    for name in dir(database):
+        func = getattr(database, name)
+        if name.startswith("_") or name in _NOT_TIMED or not callable(func):
+            continue
+        if getattr(func, "__module__", None) != "database":
+            continue
+        setattr(database, name, _timed(name, func))
+
+
+def instrument_storage():
+    """Time the storage backend's queries (SQLiteStorage is covered by instrument_database)"""
+    storage = get_storage()
+    if isinstance(storage, SQLiteStorage):
+        return
+    for name in dir(Storage):
+        if name.startswith("_") or name in _NOT_TIMED:
+            continue
+        setattr(storage, name, _timed(name, getattr(storage, name)))
+
+
+async def _process(application, updates):
+    """Feed updates one by one and return each update's handling time"""
+    latencies = []
+    for data in updates:
+        update = Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def join_flood(application, count):
+    """N join requests for a channel without auto accept (buffered into pending_requests)"""
+    updates = [harness.make_join_request(CHAT_ID, FIRST_USER_ID + i) for i in range(count)]
+    latencies = await _process(application, updates)
+    started = time.perf_counter()
+    await handlers.pending_writer.flush()
+    return count, latencies, time.perf_counter() - started
+
+
+async def auto_accept_flood(application, count):
+    """N join requests for an auto-accept channel (one approval call each)"""
+    updates = [harness.make_join_request(AUTO_CHAT_ID, FIRST_USER_ID + i) for i in range(count)]
+    latencies = await _process(application, updates)
+    return count, latencies, 0.0
+
+
+async def accept_all(application, count):
+    """accept_join_requests(count=None) on a backlog of N pending requests"""
+    rows = [(CHAT_ID, FIRST_USER_ID + i, f"User{i}", None) for i in range(count)]
+    for start in range(0, count, 10000):
+        get_storage().add_pending_requests(rows[start:start + 10000])
+    _db_times.clear()
+    started = time.perf_counter()
+    stats = await handlers.accept_join_requests(application.bot, CHAT_ID, None)
+    elapsed = time.perf_counter() - started
+    print(f"  {stats}")
+    return stats.accepted + stats.failed, [elapsed], 0.0
+
+
+async def button_mash(application, count):
+    """N menu callbacks from one owner cycling through the channel menus"""
+    cycle = [callbacks.encode(callbacks.MY_CHANNELS), callbacks.encode(callbacks.MANAGE, CHAT_ID),
+             callbacks.encode(callbacks.CHOOSE, CHAT_ID), callbacks.encode(callbacks.ACCEPT_REQUESTS),
+             callbacks.encode(callbacks.CHANNEL_ACCEPT, CHAT_ID), callbacks.encode(callbacks.BACK_MAIN)]
+    updates = [harness.make_callback_query(OWNER_ID, cycle[i % len(cycle)]) for i in range(count)]
+    latencies = await _process(application, updates)
+    return count, latencies, 0.0
+
+
+async def ordering(application, count):
+    """An owner's toggle then delete and N join requests, run concurrently by the update processor"""
+    # The ordering guarantee itself is tested in tests/test_update_processor.py
+    processor = application.update_processor
+    spans = {}
+    running = peak = 0
+
+    async def handle(name, update):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        started = time.perf_counter()
+        try:
+            await application.process_update(update)
+            # Stands in for API latency, so unrelated updates have to overlap
+            await asyncio.sleep(0.001)
+        finally:
+            running -= 1
+            spans[name] = (started, time.perf_counter())
+
+    updates = [
+        ("toggle", harness.make_callback_query(OWNER_ID, callbacks.encode(callbacks.AUTO_ACCEPT, CHAT_ID))),
+        ("delete", harness.make_callback_query(OWNER_ID, callbacks.encode(callbacks.DELETE_CHANNEL, CHAT_ID))),
+    ] + [(i, harness.make_join_request(AUTO_CHAT_ID, FIRST_USER_ID + i)) for i in range(count)]
+    # Tasks start in creation order, like the Application's update fetcher creates them
+    tasks = []
+    for name, data in updates:
+        update = Update.de_json(data, application.bot)
+        tasks.append(asyncio.create_task(processor.process_update(update, handle(name, update))))
+    await asyncio.gather(*tasks)
+
+    print(f"  peak concurrent updates: {peak}")
+    return len(updates), [end - start for start, end in spans.values()], 0.0
+
+
+SCENARIOS = {
+    "join_flood": (join_flood, 50000),
+    "auto_accept_flood": (auto_accept_flood, 20000),
+    "accept_all": (accept_all, 100000),
+    "button_mash": (button_mash, 5000),
+    "ordering": (ordering, 2000),
+}
+
+
+def report(name, operations, latencies, extra, elapsed):
+    print(f"  operations:   {operations}")
+    print(f"  elapsed:      {elapsed:.2f}s (incl. {extra:.2f}s final flush)")
+    print(f"  throughput:   {operations / elapsed:.0f} ops/s")
+    if len(latencies) > 1:
+        print(f"  p50 latency:  {harness.percentile(latencies, 50) * 1000:.3f} ms")
+        print(f"  p99 latency:  {harness.percentile(latencies, 99) * 1000:.3f} ms")
+    if _db_times:
+        print("  database time per operation:")
+        print(f"    {'function':<28}{'calls':>9}{'total ms':>11}{'avg ms':>9}{'p99 ms':>9}")
+        for func, times in sorted(_db_times.items(), key=lambda item: -sum(item[1])):
+            print(f"    {func:<28}{len(times):>9}{sum(times) * 1000:>11.1f}"
+                  f"{sum(times) / len(times) * 1000:>9.3f}"
+                  f"{harness.percentile(times, 99) * 1000:>9.3f}")
+
+
+async def run(names, count, latency, error_rate, retry_after_rate, retry_after, rate_limit,
+              storage="sqlite"):
+    instrument_database()
+    api = harness.FakeBotAPI(latency=latency, error_rate=error_rate,
+                             retry_after_rate=retry_after_rate, retry_after=retry_after,
+                             seed=1)
+    application, _ = harness.make_application(api, rate_limiter=None if rate_limit else False)
+    application.add_error_handler(_count_error)
+    harness.use_scratch_db(backend=storage)
+    await application.initialize()
+    await bot.post_init(application)
+    if not rate_limit:
+        approvals.configure_engine(application.bot, rate=float("inf"), burst=float("inf"))
+
+    for name in names:
+        scenario, default_count = SCENARIOS[name]
+        path = harness.use_scratch_db(backend=storage)
+        instrument_storage()
+        get_storage().add_channel(OWNER_ID, CHAT_ID, "Bench channel", "channel")
+        get_storage().add_channel(OWNER_ID, AUTO_CHAT_ID, "Bench auto channel", "channel")
+        get_storage().toggle_auto_accept(OWNER_ID, AUTO_CHAT_ID)
+        _db_times.clear()
+
+        print(f"\n== {name}: {scenario.__doc__} [{path}]")
+        started = time.perf_counter()
+        operations, latencies, extra = await scenario(application, count or default_count)
+        report(name, operations, latencies, extra, time.perf_counter() - started)
+
+    if api.errors:
+        print(f"\ninjected API errors: {api.errors}")
+    if _handler_errors:
+        print(f"errors raised by handlers: {_handler_errors}")
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*",
+                        help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--count", type=int, help="override each scenario's size")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of API calls failing with Bad Request")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0,
+                        help="share of API calls answered with RetryAfter")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="seconds requested by injected RetryAfter errors")
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite",
+                        help="storage backend for users, channels and pending requests")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the rate governor and approval token bucket on")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args.scenarios or list(SCENARIOS), args.count, args.latency,
+                    args.error_rate, args.retry_after_rate, args.retry_after, args.rate_limit,
+                    args.storage))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ Bot for accepting join requests for channels and groups
 """
 
 import logging
+import secrets
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,7 +15,22 @@ from telegram.ext import (
     filters
 )
 
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN,
+    UPDATE_MODE,
+    UPDATE_WORKERS,
+    SHARD_WORKERS,
+    STORAGE_BACKEND,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT
+)
 
 from handlers import (
     start_command,
@@ -22,9 +38,21 @@ from handlers import (
     handle_message,
     handle_chat_join_request,
     handle_activation_command,
-    handle_claim_callback
+    profile_command
 )
 import database
+import async_db
+from storage import get_storage
+from ingest import pending_writer
+from jobs import approval_jobs
+from maintenance import maintenance
+from recorder import recorder
+from retries import retry_queue
+from scheduler import scheduler
+from approvals import get_engine
+from ratelimit import RateGovernor
+from update_processor import KeyedUpdateProcessor
+import metrics
 
 # Setup logging
 logging.basicConfig(
@@ -33,20 +61,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def main():
-    """Start the bot"""
-    print("🤖 Starting Join Request Bot...")
-    
-    # Initialize database
-    database.init_db()
-    print("✅ Database initialized")
+ALLOWED_UPDATES = ["message", "channel_post", "callback_query", "chat_join_request"]
+
+async def post_init(application):
+    """Start background workers once the event loop is running
+
+    In sharded mode (sharding.py) approval jobs and the database-wide loops
+    run in worker 0 only.
+    """
+    shard = application.bot_data.get("shard")
+    pending_writer.start()
+    if shard is None or shard.runs_jobs:
+        await approval_jobs.resume(application.bot)
+        maintenance.start()
+        retry_queue.start(lambda: get_engine(application.bot))
+    else:
+        retry_queue.start_writer()
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # With concurrent updates the queue empties at once; the backlog waits in the processor
+    processor = application.update_processor
+    metrics.UPDATE_QUEUE_DEPTH.set_function(lambda: application.update_queue.qsize() + processor.pending)
+    metrics.PENDING_BUFFER_DEPTH.set_function(lambda: pending_writer.buffered)
+    metrics.SCHEDULER_JOBS.set_function(lambda: scheduler.active_jobs)
+    metrics.SCHEDULER_WAITING.set_function(lambda: scheduler.waiting_jobs)
+    if METRICS_ENABLED:
+        port = METRICS_PORT + (shard.index if shard is not None else 0)
+        application.bot_data["metrics_server"] = await metrics.start_server(METRICS_HOST, port)
+
+async def post_shutdown(application):
+    """Checkpoint jobs, flush buffered writes, drain the DB thread and close the database"""
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+    await maintenance.stop()
+    await approval_jobs.stop()
+    await retry_queue.stop()
+    await pending_writer.stop()
+    recorder.close()
+    async_db.shutdown()
+
+def build_application(builder=None, rate_limiter=None, record=True):
+    """Create the Application and register all handlers
+
+    builder: optional pre-configured ApplicationBuilder (e.g. with a fake request backend)
+    rate_limiter: API rate limiter to install (default RateGovernor), False for none
+    record: record incoming updates when RECORD_UPDATES_PATH is set
+    """
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    if rate_limiter is None:
+        rate_limiter = RateGovernor()
+    if rate_limiter:
+        builder = builder.rate_limiter(rate_limiter)
+    # Updates are recorded as they arrive, before waiting for a worker (opt-in, see recorder.py)
+    processor = KeyedUpdateProcessor(UPDATE_WORKERS, recorder if record and recorder.enabled else None)
+    application = (
+        builder
+        .concurrent_updates(processor)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CallbackQueryHandler(handle_claim_callback, pattern="^claim_"))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(CallbackQueryHandler(button_callback))
     
     # Handle activation command (groups & channels)
@@ -57,11 +136,53 @@ def main():
     
     application.add_handler(ChatJoinRequestHandler(handle_chat_join_request))
     
+    return application
+
+def webhook_settings(**overrides):
+    """Keyword arguments for run_webhook / Updater.start_webhook from config"""
+    settings = {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": WEBHOOK_URL or None,
+        "secret_token": WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        "allowed_updates": ALLOWED_UPDATES,
+    }
+    settings.update(overrides)
+    return settings
+
+def main():
+    """Start the bot"""
+    print("🤖 Starting Join Request Bot...")
+    
+    # Without a public URL PTB would register http://WEBHOOK_LISTEN:PORT, which Telegram rejects
+    if UPDATE_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("UPDATE_MODE = \"webhook\" needs WEBHOOK_URL (the public HTTPS URL Telegram posts to)")
+    
+    # Initialize database
+    database.init_db()
+    get_storage().open()
+    print("✅ Database initialized")
+    
+    if SHARD_WORKERS > 1:
+        if STORAGE_BACKEND != "sqlite":
+            raise SystemExit("SHARD_WORKERS needs STORAGE_BACKEND = \"sqlite\" (workers share the database file)")
+        import sharding  # imports this module, so only loaded in this mode
+        print(f"🚀 Bot is running with {SHARD_WORKERS} worker processes! Press Ctrl+C to stop.")
+        sharding.run(SHARD_WORKERS)
+        return
+    
+    application = build_application()
     print("✅ Handlers registered")
     print("🚀 Bot is running! Press Ctrl+C to stop.")
     
-    # Run the bot
-    application.run_polling(allowed_updates=["message", "channel_post", "callback_query", "chat_join_request"])
+    # Run the bot. On SIGINT/SIGTERM the receiver stops first, then every update
+    # already queued is processed before post_shutdown flushes and closes the DB.
+    if UPDATE_MODE == "webhook":
+        application.run_webhook(**webhook_settings())
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,117 @@
+"""
+Short-lived caches for Telegram lookups made by the activation flows.
+
+`.تفعيل` spammed in a busy group and repeated claim clicks would otherwise
+hit getChatMember / getChat on every update. Admin status is cached per
+(chat_id, user_id) and chat info per chat_id; entries expire after a TTL,
+the least recently used are dropped beyond CACHE_MAX_ENTRIES, and every
+entry for a chat is invalidated when a call about that chat fails or an
+approval in it is refused for lack of rights.
+"""
+
+import time
+from collections import OrderedDict
+
+from telegram import ChatMemberAdministrator, ChatMemberOwner
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+import metrics
+from config import ADMIN_CACHE_TTL, ADMIN_CACHE_NEGATIVE_TTL, CHAT_CACHE_TTL, CACHE_MAX_ENTRIES
+
+# Returned by TTLCache.get for a missing or expired key (cached values may be False)
+MISSING = object()
+
+# BadRequest descriptions meaning the bot lost its admin rights in the chat
+_RIGHTS_ERRORS = ("not enough rights", "chat_admin_required", "need administrator rights",
+                  "have no rights")
+
+
+class TTLCache:
+    """LRU cache whose entries expire `ttl` seconds after they are set"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return MISSING
+        if entry[0] <= time.monotonic():
+            del self._data[key]
+            return MISSING
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def discard_where(self, predicate):
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+
+admin_cache = TTLCache(CACHE_MAX_ENTRIES, ADMIN_CACHE_TTL)   # (chat_id, user_id) -> bool
+chat_cache = TTLCache(CACHE_MAX_ENTRIES, CHAT_CACHE_TTL)     # chat_id -> ChatFullInfo
+
+
+async def is_chat_admin(bot, chat_id, user_id):
+    """True if user_id is an administrator or the owner of chat_id (cached)"""
+    key = (chat_id, user_id)
+    status = admin_cache.get(key)
+    if status is not MISSING:
+        metrics.CACHE_LOOKUPS.inc("admin", "hit")
+        return status
+    metrics.CACHE_LOOKUPS.inc("admin", "miss")
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+    except TelegramError:
+        invalidate(chat_id)
+        raise
+    status = isinstance(member, (ChatMemberAdministrator, ChatMemberOwner))
+    # Non-admins are re-checked sooner so a fresh promotion is noticed quickly
+    admin_cache.set(key, status, None if status else ADMIN_CACHE_NEGATIVE_TTL)
+    return status
+
+
+async def get_chat(bot, chat_id):
+    """bot.get_chat with caching"""
+    chat = chat_cache.get(chat_id)
+    if chat is not MISSING:
+        metrics.CACHE_LOOKUPS.inc("chat", "hit")
+        return chat
+    metrics.CACHE_LOOKUPS.inc("chat", "miss")
+    try:
+        chat = await bot.get_chat(chat_id)
+    except TelegramError:
+        invalidate(chat_id)
+        raise
+    chat_cache.set(chat_id, chat)
+    return chat
+
+
+def is_permission_error(error):
+    """True for Forbidden, or a BadRequest saying the bot lacks admin rights"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and any(
+        text in error.message.lower() for text in _RIGHTS_ERRORS)
+
+
+def invalidate(chat_id):
+    """Forget everything cached about a chat (after a failed call or a permission error)"""
+    chat_cache.discard(chat_id)
+    admin_cache.discard_where(lambda key: key[0] == chat_id)
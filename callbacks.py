@@ -0,0 +1,151 @@
+"""
+Callback data encoding and routing for inline buttons.
+
+Buttons carry compact payloads of the form "<code>:<arg>:<arg>", e.g.
+"ac:100:-1001234567890", well under Telegram's 64-byte callback_data limit.
+Handlers register a route per code together with the argument parsers, and
+Router.dispatch splits the payload once, finds the route with a single dict
+lookup and calls the handler with typed arguments, so dispatch costs the same
+however many routes exist.
+
+Buttons sent before this encoding ("manage_-100...", "accept_all_-100...")
+stay in users' chats; they are mapped to the same routes by trying the
+underscore-separated prefixes of the payload from longest to shortest.
+"""
+
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram's limit for InlineKeyboardButton.callback_data
+MAX_CALLBACK_DATA = 64
+
+# Route codes
+ADD_CHAT = "add"           # how to add a channel/group
+MY_CHANNELS = "my"         # [page] channel list for management
+ACCEPT_REQUESTS = "ar"     # [page] channel list for accepting requests
+CHOOSE = "ch"              # chat_id: accept-count menu (from the accept list)
+MANAGE = "mg"              # chat_id: channel actions menu
+CHANNEL_ACCEPT = "ca"      # chat_id: accept-count menu (from the actions menu)
+AUTO_ACCEPT = "aa"         # chat_id: toggle auto accept
+DELETE_CHANNEL = "dc"      # chat_id: delete channel
+ACCEPT = "ac"              # count|"all", chat_id: start an approval job
+CANCEL_JOB = "cj"          # job_id: cancel an approval job
+BACK_MAIN = "bm"           # main menu
+CLAIM = "cl"               # chat_id: claim channel ownership
+
+# Pre-encoding payload prefixes -> route codes
+LEGACY_PREFIXES = {
+    "add_channel": ADD_CHAT,
+    "add_group": ADD_CHAT,
+    "my_channels": MY_CHANNELS,
+    "chpage_manage": MY_CHANNELS,
+    "accept_requests": ACCEPT_REQUESTS,
+    "chpage_choose": ACCEPT_REQUESTS,
+    "choose": CHOOSE,
+    "manage": MANAGE,
+    "channel_accept": CHANNEL_ACCEPT,
+    "auto_accept": AUTO_ACCEPT,
+    "delete_channel": DELETE_CHANNEL,
+    "accept": ACCEPT,
+    "cancel_job": CANCEL_JOB,
+    "back_main": BACK_MAIN,
+    "claim": CLAIM,
+}
+
+
+def encode(code, *args):
+    """callback_data for a route and its arguments"""
+    data = ":".join((code, *map(str, args)))
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data longer than {MAX_CALLBACK_DATA} bytes: {data!r}")
+    return data
+
+
+def count_or_all(value):
+    """Argument parser for an accept amount: an int, or None for "all" """
+    return None if value == "all" else int(value)
+
+
+class Route:
+    def __init__(self, code, handler, parsers, answer):
+        self.code = code
+        self.handler = handler
+        self.parsers = parsers
+        self.answer = answer
+        self.name = handler.__name__
+        # Arguments a payload must carry: those whose handler parameter has no default
+        parameters = list(inspect.signature(handler).parameters.values())[2:2 + len(parsers)]
+        self.required = sum(1 for p in parameters if p.default is inspect.Parameter.empty)
+
+
+class Router:
+    """Maps callback payloads to registered handler(update, context, *args)"""
+
+    def __init__(self):
+        self._routes = {}
+
+    def route(self, code, *parsers, answer=True):
+        """Register a handler for `code`
+
+        parsers: one callable per argument (trailing arguments may be left out
+        of the payload if the handler has defaults for them)
+        answer: answer the callback query before calling the handler
+        """
+        def decorator(handler):
+            if code in self._routes:
+                raise ValueError(f"Callback route {code!r} registered twice")
+            self._routes[code] = Route(code, handler, parsers, answer)
+            return handler
+        return decorator
+
+    def _split(self, data):
+        if ":" in data or data in self._routes:
+            code, *args = data.split(":")
+            return code, args
+        parts = data.split("_")
+        for end in range(len(parts), 0, -1):
+            code = LEGACY_PREFIXES.get("_".join(parts[:end]))
+            if code is not None:
+                return code, parts[end:]
+        return None, []
+
+    def parse(self, data):
+        """(route, typed args) for a payload, or (None, None) if it matches no route"""
+        code, args = self._split(data or "")
+        route = self._routes.get(code)
+        if route is None or not route.required <= len(args) <= len(route.parsers):
+            return None, None
+        try:
+            return route, [parse(arg) for parse, arg in zip(route.parsers, args)]
+        except ValueError:
+            return None, None
+
+    def code(self, data):
+        """Route code of a payload without parsing its arguments (None if unknown)"""
+        code, _ = self._split(data or "")
+        return code if code in self._routes else None
+
+    @staticmethod
+    def action_label(update, context):
+        """Metrics label for a dispatched callback: the name of the handler it routed to"""
+        route = getattr(context, "route", None)
+        return route.name if route is not None else "unknown"
+
+    async def dispatch(self, update, context):
+        """Parse the payload once, record the route in context.route and call its handler"""
+        query = update.callback_query
+        route, args = self.parse(query.data)
+        context.route = route
+        if route is None:
+            logger.warning("Unknown callback data %r", query.data)
+            await query.answer()
+            return
+        if route.answer:
+            await query.answer()
+        await route.handler(update, context, *args)
+
+
+# Shared router the handlers register their routes on
+router = Router()
@@ -3,3 +3,100 @@ BOT_TOKEN = "8555735915:AAGa-UEMzSHuOt55zfmDojy_ny281yqDFgY"
 
 # Admin IDs (add your Telegram user ID here for admin access)
 ADMIN_IDS = [8190456871]
+
+# Storage of users, channels and pending requests: "sqlite" or "memory"
+STORAGE_BACKEND = "sqlite"
+DB_PATH = ""                     # SQLite file (approval jobs and retries live here with either backend); empty = bot_data.db next to the code
+MEMORY_SNAPSHOT_PATH = ""        # memory backend snapshot (log at <path>.aof); empty = bot_data.snapshot.json next to DB_PATH
+MEMORY_SNAPSHOT_INTERVAL = 300   # seconds between snapshots; the append-only log covers the time in between
+
+# Join request ingestion (write-behind buffer for pending_requests)
+PENDING_BUFFER_SIZE = 10000      # max buffered requests before handlers wait
+PENDING_FLUSH_ROWS = 500         # flush when this many rows are buffered
+PENDING_FLUSH_INTERVAL = 0.25    # or after this many seconds
+
+# Users remembered in memory so repeated /start does not rewrite them
+KNOWN_USERS_CACHE_SIZE = 50000
+
+# Database maintenance (expiry of stale pending requests + incremental vacuum)
+# Opt-in: with a TTL, requests older than it are deleted for good
+PENDING_TTL_DAYS = 0             # pending requests older than this are dropped (0 keeps them)
+MAINTENANCE_INTERVAL = 3600      # seconds between maintenance runs
+MAINTENANCE_BATCH_SIZE = 5000    # rows deleted per transaction
+
+# Bulk approvals (accept_join_requests)
+APPROVAL_RATE = 25               # approvals per second (token bucket refill rate)
+APPROVAL_BURST = 25              # token bucket capacity
+APPROVAL_CONCURRENCY = 16        # approvals in flight at once
+APPROVAL_MAX_RETRIES = 3         # retries for network errors / timeouts per user
+
+# Retry queue for approvals that failed with a transient error (flood wait, network, timeout)
+RETRY_BASE_DELAY = 5.0           # seconds before the first retry, doubled per attempt
+RETRY_MAX_DELAY = 600.0          # cap on the backoff
+RETRY_MAX_ATTEMPTS = 8           # then the request is kept in pending_requests for a manual accept
+RETRY_BATCH_SIZE = 200           # due retries approved per round
+RETRY_POLL_INTERVAL = 1.0        # seconds between rounds when nothing is due
+RETRY_BUFFER_SIZE = 10000        # max deferrals buffered before approvals wait for a write
+RETRY_FLUSH_ROWS = 500           # write deferrals when this many are buffered
+RETRY_FLUSH_INTERVAL = 0.25      # or after this many seconds
+
+# Background approval jobs
+JOB_BATCH_SIZE = 100             # users approved between checkpoints
+JOB_PROGRESS_INTERVAL = 3.0      # min seconds between progress message edits
+JOB_SHUTDOWN_GRACE = 10.0        # seconds to let running batches finish on shutdown
+
+# Fair scheduling of approval jobs between owners (deficit round robin)
+SCHEDULER_QUANTUM = 50           # approvals credited to an owner per round (times its weight)
+SCHEDULER_SLOTS = 2              # job slices approved at the same time
+SCHEDULER_MAX_JOBS_PER_OWNER = 3 # approval jobs one owner can run at once
+SCHEDULER_OWNER_WEIGHTS = {}     # owner user_id -> weight, e.g. {123456789: 2}; others get 1
+
+# How updates are received: "polling" or "webhook"
+UPDATE_MODE = "polling"
+UPDATE_WORKERS = 64              # updates processed concurrently (same chat/user stay in order)
+
+# Multi-process mode: an ingress process routes updates to worker processes by chat_id
+SHARD_WORKERS = 0                # worker processes (0 or 1 runs everything in one process)
+SHARD_QUEUE_SIZE = 10000         # updates queued per worker before the ingress waits
+SHARD_INDEX_REFRESH = 1.0        # seconds between checks for auto accept changes by other workers
+SHARD_FLUSH_POLL = 0.05          # seconds between checks for flushes asked for by another worker
+SHARD_FLUSH_TIMEOUT = 5.0        # seconds an approval job waits for the owning worker's flush
+
+# Webhook mode (needs python-telegram-bot[webhooks])
+WEBHOOK_LISTEN = "127.0.0.1"     # local address of the embedded HTTP server
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"        # URL path the server accepts updates on
+WEBHOOK_URL = ""                 # required: public HTTPS URL Telegram posts to (e.g. a reverse proxy)
+WEBHOOK_SECRET = ""              # X-Telegram-Bot-Api-Secret-Token; random per start when empty
+WEBHOOK_MAX_CONNECTIONS = 40     # max simultaneous connections Telegram opens (1-100)
+
+# Global Telegram API rate governor (all bot calls)
+RATE_LIMIT_GLOBAL = 30           # API calls per second across the whole bot
+RATE_LIMIT_GLOBAL_BURST = 30
+RATE_LIMIT_PRIVATE_CHAT = 1.0    # messages/edits per second in one private chat
+RATE_LIMIT_GROUP_CHAT = 20 / 60  # messages per second in one group or channel
+RATE_LIMIT_CHAT_BURST = 3
+RATE_LIMIT_MAX_RETRIES = 3       # RetryAfter retries before the error reaches the caller
+
+# Channel lists in the bot menus
+CHANNELS_PAGE_SIZE = 10          # channels per page ("my channels" / accept requests)
+
+# Cached Telegram lookups for .تفعيل and channel claims
+ADMIN_CACHE_TTL = 300            # seconds an admin/owner status is trusted
+ADMIN_CACHE_NEGATIVE_TTL = 60    # seconds a "not an admin" answer is trusted
+CHAT_CACHE_TTL = 600             # seconds chat info (getChat) is kept
+CACHE_MAX_ENTRIES = 10000        # per cache, least recently used dropped first
+
+# Recording of incoming updates for replay.py (gzip JSON lines)
+RECORD_UPDATES_PATH = ""         # file to append to, e.g. "updates.jsonl.gz"; empty = off
+RECORD_FLUSH_INTERVAL = 1.0      # seconds between flushes of the compressed stream
+
+# Metrics endpoint (Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics)
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# Admin /profile command (cProfile of the running bot)
+PROFILE_DEFAULT_SECONDS = 30     # window when /profile is sent without a duration
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP_FUNCTIONS = 25       # functions listed in the report message
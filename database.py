@@ -1,15 +1,60 @@
 import sqlite3
 import os
+import logging
+import threading
+from collections import OrderedDict
 
-DB_PATH = os.path.join(os.path.dirname(__file__), 'bot_data.db')
+from config import KNOWN_USERS_CACHE_SIZE, DB_PATH as CONFIGURED_DB_PATH
 
-def init_db():
-    """Initialize the database with required tables"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+DB_PATH = CONFIGURED_DB_PATH or os.path.join(os.path.dirname(__file__), 'bot_data.db')
+
+logger = logging.getLogger(__name__)
+
+# Long-lived connection shared by every query (see get_connection)
+_conn = None
+_lock = threading.RLock()
+_schema_ready = False
+
+# In-memory index of auto accept chats: chat_id -> set of owner user_ids
+_auto_accept_index = {}
+# PRAGMA data_version when the index was last loaded (see refresh_auto_accept_index)
+_data_version = None
+
+# LRU of users as last written: user_id -> (username, first_name)
+_known_users = OrderedDict()
+
+def get_connection():
+    """Return the shared connection, opening and tuning it on first use"""
+    global _conn
+    with _lock:
+        if _conn is None:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            # Before journal_mode, which writes the header of a new database: only
+            # takes effect on a new database; init_db converts existing ones
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA temp_store = MEMORY')
+            conn.execute('PRAGMA cache_size = -16000')
+            conn.execute('PRAGMA busy_timeout = 5000')
+            _conn = conn
+        return _conn
+
+def close_connection():
+    """Close the shared connection"""
+    global _conn, _schema_ready
+    with _lock:
+        _schema_ready = False
+        _known_users.clear()
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+def _migration_1(conn):
+    """Base tables"""
     # Users table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -17,9 +62,9 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+
     # Channels/Groups table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS channels (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -32,9 +77,9 @@ def init_db():
             UNIQUE(user_id, chat_id)
         )
     ''')
-    
+
     # Pending join requests table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS pending_requests (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER,
@@ -45,153 +90,508 @@ def init_db():
             UNIQUE(chat_id, user_id)
         )
     ''')
-    
-    conn.commit()
-    conn.close()
+
+def _migration_2(conn):
+    """Background approval jobs (checkpointed so a restart can resume them)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS approval_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER,
+            chat_id INTEGER,
+            requested INTEGER,
+            processed INTEGER DEFAULT 0,
+            accepted INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            retried INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            message_chat_id INTEGER,
+            message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migration_3(conn):
+    """Indexes for the hot queries"""
+    # Partial covering index for load_auto_accept_index / get_auto_accept_channels
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_auto_accept
+        ON channels(chat_id, user_id) WHERE auto_accept = 1
+    ''')
+    # Keyset pagination of a chat's backlog without a sort step
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_chat_created
+        ON pending_requests(chat_id, created_at, id)
+    ''')
+    # Resuming jobs only looks at the few running ones
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_approval_jobs_running
+        ON approval_jobs(id) WHERE status = 'running'
+    ''')
+
+def _migration_4(conn):
+    """Per-chat pending request counters maintained by triggers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_counts (
+            chat_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO pending_counts (chat_id, count)
+        SELECT chat_id, COUNT(*) FROM pending_requests GROUP BY chat_id
+    ''')
+    # Re-requests are upserts (see add_pending_request), so only a real insert
+    # or delete changes the count
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_pending_count_insert
+        AFTER INSERT ON pending_requests
+        BEGIN
+            INSERT INTO pending_counts (chat_id, count) VALUES (NEW.chat_id, 1)
+            ON CONFLICT(chat_id) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_pending_count_delete
+        AFTER DELETE ON pending_requests
+        BEGIN
+            UPDATE pending_counts SET count = count - 1 WHERE chat_id = OLD.chat_id;
+        END
+    ''')
+
+def _migration_5(conn):
+    """Index for expiring old pending requests"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_created
+        ON pending_requests(created_at)
+    ''')
+
+def _migration_6(conn):
+    """Index for paginated channel lists"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channels_user
+        ON channels(user_id, id)
+    ''')
+
+def _migration_7(conn):
+    """Durable queue of approvals to retry after transient errors"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS approval_retries (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            first_name TEXT,
+            username TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_approval_retries_due
+        ON approval_retries(next_attempt_at)
+    ''')
+
+# Ordered schema migrations; a migration's version is its position (1-based)
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+]
+
+def get_schema_version():
+    """Get the version of the last applied migration (0 for a new database)"""
+    with _lock:
+        conn = get_connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+
+def init_db():
+    """Bring the database schema up to date, applying each pending migration once"""
+    global _schema_ready
+    with _lock:
+        if _schema_ready:
+            return
+        conn = get_connection()
+        current = get_schema_version()
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version <= current:
+                continue
+            conn.execute('BEGIN')
+            try:
+                migration(conn)
+                conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info("Applied database migration %d (%s)", version, migration.__doc__)
+        _enable_incremental_vacuum(conn)
+        _schema_ready = True
+
+def _enable_incremental_vacuum(conn):
+    """Switch a database created without auto_vacuum to INCREMENTAL (one full VACUUM)"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    # Rewrites the whole file once, so startup waits for it on a large database
+    logger.info("Enabling incremental vacuum on %s (one-time VACUUM)...", DB_PATH)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    logger.info("Enabled incremental vacuum on %s", DB_PATH)
 
 def add_user(user_id, username, first_name):
-    """Add or update a user"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, username, first_name)
-        VALUES (?, ?, ?)
-    ''', (user_id, username, first_name))
-    conn.commit()
-    conn.close()
+    """Add or update a user (no write if the user is known and unchanged)"""
+    with _lock:
+        if _known_users.get(user_id) == (username, first_name):
+            _known_users.move_to_end(user_id)
+            return
+        conn = get_connection()
+        # Upsert keeps created_at and only touches the row when something changed
+        conn.execute('''
+            INSERT INTO users (user_id, username, first_name)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name
+            WHERE username IS NOT excluded.username OR first_name IS NOT excluded.first_name
+        ''', (user_id, username, first_name))
+        conn.commit()
+        _known_users[user_id] = (username, first_name)
+        _known_users.move_to_end(user_id)
+        if len(_known_users) > KNOWN_USERS_CACHE_SIZE:
+            _known_users.popitem(last=False)
 
 def add_channel(user_id, chat_id, title, chat_type):
     """Add a channel/group for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO channels (user_id, chat_id, title, chat_type)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, chat_id, title, chat_type))
-        conn.commit()
-        result = True
-    except sqlite3.IntegrityError:
-        result = False
-    conn.close()
+    with _lock:
+        conn = get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO channels (user_id, chat_id, title, chat_type)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, chat_id, title, chat_type))
+            conn.commit()
+            result = True
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            result = False
+    if result:
+        _set_auto_accept(user_id, chat_id, False)
     return result
 
-def get_user_channels(user_id):
-    """Get all channels/groups for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM channels WHERE user_id = ?
-    ''', (user_id,))
-    channels = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return channels
+def get_user_channels(user_id, limit=-1, offset=0):
+    """Get a user's channels/groups with their pending request counts (all by default, or one page)"""
+    with _lock:
+        cursor = get_connection().execute('''
+            SELECT c.*, COALESCE(p.count, 0) AS pending_count
+            FROM channels c LEFT JOIN pending_counts p ON p.chat_id = c.chat_id
+            WHERE c.user_id = ?
+            ORDER BY c.id
+            LIMIT ? OFFSET ?
+        ''', (user_id, limit, offset))
+        return [dict(row) for row in cursor.fetchall()]
 
 def get_channel(user_id, chat_id):
-    """Get a specific channel"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM channels WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    row = cursor.fetchone()
-    conn.close()
+    """Get a specific channel, with its pending request count"""
+    with _lock:
+        cursor = get_connection().execute('''
+            SELECT c.*, COALESCE(p.count, 0) AS pending_count
+            FROM channels c LEFT JOIN pending_counts p ON p.chat_id = c.chat_id
+            WHERE c.user_id = ? AND c.chat_id = ?
+        ''', (user_id, chat_id))
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 def delete_channel(user_id, chat_id):
     """Delete a channel/group"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        DELETE FROM channels WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    conn.commit()
-    conn.close()
+    with _lock:
+        conn = get_connection()
+        conn.execute('''
+            DELETE FROM channels WHERE user_id = ? AND chat_id = ?
+        ''', (user_id, chat_id))
+        conn.commit()
+    _set_auto_accept(user_id, chat_id, False)
 
 def toggle_auto_accept(user_id, chat_id):
     """Toggle auto accept for a channel"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE channels SET auto_accept = CASE WHEN auto_accept = 0 THEN 1 ELSE 0 END
-        WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    conn.commit()
-    
-    cursor.execute('''
-        SELECT auto_accept FROM channels WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else 0
+    with _lock:
+        conn = get_connection()
+        conn.execute('''
+            UPDATE channels SET auto_accept = CASE WHEN auto_accept = 0 THEN 1 ELSE 0 END
+            WHERE user_id = ? AND chat_id = ?
+        ''', (user_id, chat_id))
+        conn.commit()
+
+        result = conn.execute('''
+            SELECT auto_accept FROM channels WHERE user_id = ? AND chat_id = ?
+        ''', (user_id, chat_id)).fetchone()
+    status = result[0] if result else 0
+    _set_auto_accept(user_id, chat_id, bool(status))
+    return status
 
 def get_auto_accept_channels():
     """Get all channels with auto accept enabled"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM channels WHERE auto_accept = 1
-    ''')
-    channels = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return channels
+    with _lock:
+        cursor = get_connection().execute('''
+            SELECT * FROM channels WHERE auto_accept = 1
+        ''')
+        return [dict(row) for row in cursor.fetchall()]
+
+def load_auto_accept_index():
+    """Load the in-memory auto accept index from the database"""
+    global _auto_accept_index, _data_version
+    with _lock:
+        conn = get_connection()
+        _data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        rows = conn.execute('''
+            SELECT chat_id, user_id FROM channels WHERE auto_accept = 1
+        ''').fetchall()
+    index = {}
+    for chat_id, user_id in rows:
+        index.setdefault(chat_id, set()).add(user_id)
+    # Swapped in whole so a lookup never sees a half-built index
+    _auto_accept_index = index
+
+def refresh_auto_accept_index():
+    """Reload the auto accept index if another process wrote to the database
+
+    Sharded workers share the database file but each keep their own index;
+    PRAGMA data_version only changes when another connection commits.
+    Returns True if the index was reloaded.
+    """
+    with _lock:
+        version = get_connection().execute('PRAGMA data_version').fetchone()[0]
+    if version == _data_version:
+        return False
+    load_auto_accept_index()
+    return True
+
+def _set_auto_accept(user_id, chat_id, enabled):
+    """Keep the auto accept index in sync after a write"""
+    owners = _auto_accept_index.get(chat_id)
+    if enabled:
+        _auto_accept_index.setdefault(chat_id, set()).add(user_id)
+    elif owners is not None:
+        owners.discard(user_id)
+        if not owners:
+            del _auto_accept_index[chat_id]
+
+def is_auto_accept(chat_id):
+    """Check if any owner enabled auto accept for a chat (no DB round trip)"""
+    return chat_id in _auto_accept_index
+
+# Insert a join request, or refresh a repeated one (moves it to the end of the backlog)
+_UPSERT_PENDING = '''
+    INSERT INTO pending_requests (chat_id, user_id, first_name, username)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        first_name = excluded.first_name,
+        username = excluded.username,
+        created_at = CURRENT_TIMESTAMP
+'''
 
 def add_pending_request(chat_id, user_id, first_name, username):
     """Add a pending join request"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT OR REPLACE INTO pending_requests (chat_id, user_id, first_name, username)
-            VALUES (?, ?, ?, ?)
-        ''', (chat_id, user_id, first_name, username))
-        conn.commit()
-        result = True
-    except:
-        result = False
-    conn.close()
+    with _lock:
+        conn = get_connection()
+        try:
+            conn.execute(_UPSERT_PENDING, (chat_id, user_id, first_name, username))
+            conn.commit()
+            result = True
+        except sqlite3.Error:
+            conn.rollback()
+            result = False
+    return result
+
+def add_pending_requests(rows):
+    """Add many pending join requests in a single transaction
+
+    rows: iterable of (chat_id, user_id, first_name, username)
+    """
+    with _lock:
+        conn = get_connection()
+        try:
+            conn.executemany(_UPSERT_PENDING, rows)
+            conn.commit()
+            result = True
+        except sqlite3.Error:
+            conn.rollback()
+            result = False
     return result
 
 def get_pending_requests(chat_id, limit=None):
     """Get pending requests for a chat"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    if limit:
-        cursor.execute('''
-            SELECT * FROM pending_requests WHERE chat_id = ? ORDER BY created_at ASC LIMIT ?
-        ''', (chat_id, limit))
-    else:
-        cursor.execute('''
-            SELECT * FROM pending_requests WHERE chat_id = ? ORDER BY created_at ASC
-        ''', (chat_id,))
-    requests = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return requests
+    with _lock:
+        conn = get_connection()
+        if limit:
+            cursor = conn.execute('''
+                SELECT * FROM pending_requests WHERE chat_id = ? ORDER BY created_at ASC LIMIT ?
+            ''', (chat_id, limit))
+        else:
+            cursor = conn.execute('''
+                SELECT * FROM pending_requests WHERE chat_id = ? ORDER BY created_at ASC
+            ''', (chat_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+def get_pending_page(chat_id, limit, after=None):
+    """Get the next `limit` pending requests of a chat in (created_at, id) order
+
+    after: (created_at, id) of the last row of the previous page, or None to start
+    """
+    with _lock:
+        conn = get_connection()
+        if after is None:
+            cursor = conn.execute('''
+                SELECT * FROM pending_requests WHERE chat_id = ?
+                ORDER BY created_at, id LIMIT ?
+            ''', (chat_id, limit))
+        else:
+            cursor = conn.execute('''
+                SELECT * FROM pending_requests WHERE chat_id = ? AND (created_at, id) > (?, ?)
+                ORDER BY created_at, id LIMIT ?
+            ''', (chat_id, after[0], after[1], limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+def iter_pending_requests(chat_id, chunk_size=500):
+    """Yield pending requests of a chat in chunks, using keyset pagination"""
+    after = None
+    while True:
+        chunk = get_pending_page(chat_id, chunk_size, after)
+        if not chunk:
+            return
+        yield chunk
+        after = (chunk[-1]['created_at'], chunk[-1]['id'])
 
 def delete_pending_request(chat_id, user_id):
     """Delete a pending request after accepting"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        DELETE FROM pending_requests WHERE chat_id = ? AND user_id = ?
-    ''', (chat_id, user_id))
-    conn.commit()
-    conn.close()
+    with _lock:
+        conn = get_connection()
+        conn.execute('''
+            DELETE FROM pending_requests WHERE chat_id = ? AND user_id = ?
+        ''', (chat_id, user_id))
+        conn.commit()
+
+def delete_pending_requests(chat_id, user_ids):
+    """Delete a batch of processed pending requests in a single transaction"""
+    with _lock:
+        conn = get_connection()
+        conn.executemany('''
+            DELETE FROM pending_requests WHERE chat_id = ? AND user_id = ?
+        ''', [(chat_id, user_id) for user_id in user_ids])
+        conn.commit()
 
 def get_pending_count(chat_id):
-    """Get count of pending requests for a chat"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT COUNT(*) FROM pending_requests WHERE chat_id = ?
-    ''', (chat_id,))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
-
-# Initialize database on import
-init_db()
+    """Get count of pending requests for a chat (maintained counter, no scan)"""
+    with _lock:
+        row = get_connection().execute('''
+            SELECT count FROM pending_counts WHERE chat_id = ?
+        ''', (chat_id,)).fetchone()
+    return row[0] if row else 0
+
+def expire_pending_requests(max_age_seconds, limit):
+    """Delete up to `limit` pending requests older than max_age_seconds; returns the number deleted"""
+    with _lock:
+        conn = get_connection()
+        cursor = conn.execute('''
+            DELETE FROM pending_requests WHERE id IN (
+                SELECT id FROM pending_requests
+                WHERE created_at < datetime('now', ?)
+                LIMIT ?
+            )
+        ''', (f'-{int(max_age_seconds)} seconds', limit))
+        conn.commit()
+        return cursor.rowcount
+
+def incremental_vacuum(pages=0):
+    """Return free pages to the filesystem (all when pages is 0); returns the number freed"""
+    with _lock:
+        conn = get_connection()
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        # execute() stops after the first step (one page); executescript runs it to completion
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+def schedule_approval_retries(rows):
+    """Add or reschedule approvals to retry in a single transaction
+
+    rows: iterable of (chat_id, user_id, first_name, username, attempts, next_attempt_at, last_error)
+    """
+    with _lock:
+        conn = get_connection()
+        conn.executemany('''
+            INSERT INTO approval_retries
+                (chat_id, user_id, first_name, username, attempts, next_attempt_at, last_error)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                attempts = excluded.attempts,
+                next_attempt_at = excluded.next_attempt_at,
+                last_error = excluded.last_error
+        ''', rows)
+        conn.commit()
+
+def get_due_approval_retries(now, limit):
+    """Get up to `limit` retries whose next attempt is due at unix time `now`, oldest first"""
+    with _lock:
+        cursor = get_connection().execute('''
+            SELECT * FROM approval_retries WHERE next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+        ''', (now, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+def delete_approval_retries(keys):
+    """Remove finished retries; keys: iterable of (chat_id, user_id)"""
+    with _lock:
+        conn = get_connection()
+        conn.executemany('''
+            DELETE FROM approval_retries WHERE chat_id = ? AND user_id = ?
+        ''', keys)
+        conn.commit()
+
+def get_approval_retry_count():
+    """Get the number of approvals waiting to be retried"""
+    with _lock:
+        return get_connection().execute('SELECT COUNT(*) FROM approval_retries').fetchone()[0]
+
+def create_approval_job(owner_id, chat_id, requested, message_chat_id, message_id):
+    """Create a running approval job and return its id (requested=None means all)"""
+    with _lock:
+        conn = get_connection()
+        cursor = conn.execute('''
+            INSERT INTO approval_jobs (owner_id, chat_id, requested, message_chat_id, message_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (owner_id, chat_id, requested, message_chat_id, message_id))
+        conn.commit()
+        return cursor.lastrowid
+
+def update_approval_job(job_id, processed, accepted, failed, retried, status=None):
+    """Save an approval job checkpoint (and optionally its final status)"""
+    with _lock:
+        conn = get_connection()
+        conn.execute('''
+            UPDATE approval_jobs
+            SET processed = ?, accepted = ?, failed = ?, retried = ?,
+                status = COALESCE(?, status), updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (processed, accepted, failed, retried, status, job_id))
+        conn.commit()
+
+def get_approval_job(job_id):
+    """Get an approval job"""
+    with _lock:
+        row = get_connection().execute('''
+            SELECT * FROM approval_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_running_approval_jobs():
+    """Get approval jobs that have not finished (to resume after a restart)"""
+    with _lock:
+        cursor = get_connection().execute('''
+            SELECT * FROM approval_jobs WHERE status = 'running' ORDER BY id
+        ''')
+        return [dict(row) for row in cursor.fetchall()]
@@ -1,7 +1,21 @@
-from telegram import Update, ChatMemberAdministrator, ChatMemberOwner, InlineKeyboardMarkup, InlineKeyboardButton
+import html
+import math
+import time
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
 from telegram.error import TelegramError
-import database as db
+import async_db as db
+import cache
+from ingest import pending_writer
+from approvals import drain_pending
+from ratelimit import FAIL_FAST, is_transient
+from retries import retry_queue
+from jobs import approval_jobs
+from metrics import timed_handler
+import callbacks
+from callbacks import router
+from profiler import profiler
+from config import ADMIN_IDS, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS, PROFILE_TOP_FUNCTIONS, CHANNELS_PAGE_SIZE
 from keyboards import (
     get_main_keyboard, 
     get_channels_keyboard, 
@@ -14,6 +28,7 @@ from keyboards import (
 user_states = {}
 
 
+@timed_handler("handle_activation_command")
 async def handle_activation_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle .تفعيل command in groups and channels"""
     message = update.message or update.channel_post
@@ -27,49 +42,47 @@ async def handle_activation_command(update: Update, context: ContextTypes.DEFAUL
     chat_type = chat.type
     
     try:
-        bot_member = await context.bot.get_chat_member(chat.id, context.bot.id)
-        if not isinstance(bot_member, (ChatMemberAdministrator, ChatMemberOwner)):
+        if not await cache.is_chat_admin(context.bot, chat.id, context.bot.id):
             await message.reply_text("❌ البوت يحتاج صلاحيات أدمن للتفعيل (مع صلاحية دعوة المستخدمين).")
             return
     except TelegramError:
+        cache.invalidate(chat.id)
         return
 
     if chat_type in ['group', 'supergroup']:
         user = message.from_user
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        if not isinstance(member, (ChatMemberAdministrator, ChatMemberOwner)):
+        if not await cache.is_chat_admin(context.bot, chat.id, user.id):
             await message.reply_text("❌ هذا الأمر للمشرفين فقط.")
             return
 
-        if db.add_channel(user.id, chat.id, chat.title, "group"):
+        if await db.add_channel(user.id, chat.id, chat.title, "group"):
             await message.reply_text("✅ تم تفعيل المجموعه بنجاح! وربطها بحسابك.\nيمكنك الآن إدارتها من البوت.")
         else:
             await message.reply_text("✅ المجموعه مفعلة مسبقاً.")
 
     elif chat_type == 'channel':
         keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("✅ أنا مالك القناة (اضغط للتفعيل)", callback_data=f"claim_{chat.id}")
+            InlineKeyboardButton("✅ أنا مالك القناة (اضغط للتفعيل)", callback_data=callbacks.encode(callbacks.CLAIM, chat.id))
         ]])
         await message.reply_text(
             "🔒 لتأكيد تفعيل القناة وربطها بحسابك، اضغط على الزر أدناه:",
             reply_markup=keyboard
         )
 
-async def handle_claim_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route(callbacks.CLAIM, int, answer=False)
+async def handle_claim_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id):
     """Handle channel ownership claim"""
     query = update.callback_query
     user = query.from_user
-    chat_id = int(query.data.split("_")[1])
     
     try:
-        member = await context.bot.get_chat_member(chat_id, user.id)
-        if not isinstance(member, (ChatMemberAdministrator, ChatMemberOwner)):
+        if not await cache.is_chat_admin(context.bot, chat_id, user.id):
             await query.answer("❌ لست مشرفاً في هذه القناة!", show_alert=True)
             return
             
-        chat = await context.bot.get_chat(chat_id)
+        chat = await cache.get_chat(context.bot, chat_id)
         
-        if db.add_channel(user.id, chat_id, chat.title, "channel"):
+        if await db.add_channel(user.id, chat_id, chat.title, "channel"):
             await query.answer("✅ تم التفعيل بنجاح!")
             await query.edit_message_text(f"✅ تم تفعيل القناة بنجاح بواسطة {user.first_name}!")
         else:
@@ -77,12 +90,14 @@ async def handle_claim_callback(update: Update, context: ContextTypes.DEFAULT_TY
             await query.edit_message_text(f"✅ القناة مفعلة مسبقاً.")
             
     except TelegramError as e:
+        cache.invalidate(chat_id)
         await query.answer("❌ حدث خطأ، تأكد أن البوت لا يزال أدمن", show_alert=True)
 
+@timed_handler("start_command")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name)
+    await db.add_user(user.id, user.username, user.first_name)
     
     welcome_text = f"""👋❤️ مرحبا {user.first_name}
 • بوت قبول طلبات الانضمام الخاصة بالقنوات والكروبات✅.
@@ -99,151 +114,173 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard()
     )
 
+async def show_channels(query, user_id, list_code, page=0):
+    """Show one page of the user's channels: MY_CHANNELS (manage) or ACCEPT_REQUESTS (choose)"""
+    # One extra row tells whether there is a next page without counting
+    channels = await db.get_user_channels(user_id, CHANNELS_PAGE_SIZE + 1, page * CHANNELS_PAGE_SIZE)
+    if not channels and page > 0:
+        # The page emptied (e.g. after a delete): go back to the first one
+        page = 0
+        channels = await db.get_user_channels(user_id, CHANNELS_PAGE_SIZE + 1, 0)
+    has_next = len(channels) > CHANNELS_PAGE_SIZE
+    channels = channels[:CHANNELS_PAGE_SIZE]
+    manage = list_code == callbacks.MY_CHANNELS
+
+    if not channels:
+        if manage:
+            text = "❌ لا توجد قنوات أو مجموعات مضافة\n\nأضف البوت لقناة/كروب وأرسل `.تفعيل`"
+        else:
+            text = "❌ لا توجد قنوات أو مجموعات\n\nأضف قناة أو كروب أولاً"
+        await query.edit_message_text(text, reply_markup=get_main_keyboard())
+        return
+
+    if manage:
+        text = "📋 قنواتي وكروباتي:\n\n"
+        for ch in channels:
+            ch_type = "📢" if ch['chat_type'] == 'channel' else "👥"
+            auto = "✅ تلقائي" if ch['auto_accept'] else ""
+            text += f"{ch_type} {ch['title']} ({ch['pending_count']}) {auto}\n"
+    else:
+        text = "✅ اختر القناة أو الكروب لقبول طلبات الانضمام:"
+    if page > 0 or has_next:
+        text = text.rstrip() + f"\n\n📄 صفحة {page + 1}"
+
+    item_code = callbacks.MANAGE if manage else callbacks.CHOOSE
+    await query.edit_message_text(
+        text,
+        reply_markup=get_channels_keyboard(channels, item_code, page, has_next, list_code)
+    )
+
+def format_accept_menu(channel):
+    """Text of the accept-count menu for a channel"""
+    pending = channel['pending_count']
+    if not pending:
+        return f"📊 {channel['title']}\n\nلا توجد طلبات انضمام معلقة حالياً"
+    return (
+        f"📊 {channel['title']}\n"
+        f"الطلبات المعلقة: {pending}\n\n"
+        "كم عدد طلبات الانضمام الذي تريد قبوله؟ اختر العدد\n"
+        "او يمكنك قبول جميع الطلبات"
+    )
+
+def format_channel_actions(channel):
+    """Text of the actions menu for a channel"""
+    ch_type = "قناة" if channel['chat_type'] == 'channel' else "كروب"
+    auto_status = "مفعل ✅" if channel['auto_accept'] else "معطل ❌"
+    return (
+        f"📋 {channel['title']}\n"
+        f"النوع: {ch_type}\n"
+        f"القبول التلقائي: {auto_status}\n"
+        f"الطلبات المعلقة: {channel['pending_count']}"
+    )
+
+@timed_handler("button_callback", action=router.action_label)
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button callbacks"""
+    """Handle button callbacks (dispatched through callbacks.router)"""
+    await router.dispatch(update, context)
+
+@router.route(callbacks.ADD_CHAT)
+async def show_add_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """How to add a channel or group"""
+    await update.callback_query.edit_message_text(
+        "📢 لإضافة قناة أو كروب:\n\n"
+        "1. أضف البوت كأدمن في القناة/الكروب\n"
+        "2. أرسل `.تفعيل` في القناة/الكروب\n\n"
+        "سيتم ربطها بحسابك تلقائياً!",
+        reply_markup=get_back_keyboard()
+    )
+
+@router.route(callbacks.MY_CHANNELS, int)
+async def show_my_channels(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    """Channel list for management"""
+    await show_channels(update.callback_query, update.effective_user.id, callbacks.MY_CHANNELS, page)
+
+@router.route(callbacks.ACCEPT_REQUESTS, int)
+async def show_accept_channels(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    """Channel list for accepting requests"""
+    await show_channels(update.callback_query, update.effective_user.id, callbacks.ACCEPT_REQUESTS, page)
+
+@router.route(callbacks.CHOOSE, int)
+@router.route(callbacks.CHANNEL_ACCEPT, int)
+async def show_accept_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Accept-count menu for a channel"""
+    channel = await db.get_channel(update.effective_user.id, chat_id)
+    if channel:
+        await update.callback_query.edit_message_text(
+            format_accept_menu(channel),
+            reply_markup=get_accept_count_keyboard(chat_id, channel['pending_count'])
+        )
+
+@router.route(callbacks.MANAGE, int)
+async def show_channel_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Actions menu for a channel"""
+    channel = await db.get_channel(update.effective_user.id, chat_id)
+    if channel:
+        await update.callback_query.edit_message_text(
+            format_channel_actions(channel),
+            reply_markup=get_channel_actions_keyboard(chat_id)
+        )
+
+@router.route(callbacks.AUTO_ACCEPT, int, answer=False)
+async def toggle_auto_accept(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Toggle auto accept for a channel"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = update.effective_user.id
-    data = query.data
+    new_status = await db.toggle_auto_accept(user_id, chat_id)
+    status_text = "مفعل ✅" if new_status else "معطل ❌"
+    await query.answer(f"القبول التلقائي: {status_text}", show_alert=True)
     
-    if data == "add_channel" or data == "add_group":
+    channel = await db.get_channel(user_id, chat_id)
+    if channel:
         await query.edit_message_text(
-            "📢 لإضافة قناة أو كروب:\n\n"
-            "1. أضف البوت كأدمن في القناة/الكروب\n"
-            "2. أرسل `.تفعيل` في القناة/الكروب\n\n"
-            "سيتم ربطها بحسابك تلقائياً!",
-            reply_markup=get_back_keyboard()
+            format_channel_actions(channel),
+            reply_markup=get_channel_actions_keyboard(chat_id)
         )
-    
-    elif data == "my_channels":
-        channels = db.get_user_channels(user_id)
-        if not channels:
-            await query.edit_message_text(
-                "❌ لا توجد قنوات أو مجموعات مضافة\n\n"
-                "أضف البوت لقناة/كروب وأرسل `.تفعيل`",
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            text = "📋 قنواتي وكروباتي:\n\n"
-            for ch in channels:
-                ch_type = "📢" if ch['chat_type'] == 'channel' else "👥"
-                auto = "✅ تلقائي" if ch['auto_accept'] else ""
-                text += f"{ch_type} {ch['title']} {auto}\n"
-            
-            await query.edit_message_text(
-                text,
-                reply_markup=get_channels_keyboard(channels, "manage")
-            )
-    
-    elif data == "accept_requests":
-        channels = db.get_user_channels(user_id)
-        if not channels:
-            await query.edit_message_text(
-                "❌ لا توجد قنوات أو مجموعات\n\n"
-                "أضف قناة أو كروب أولاً",
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            await query.edit_message_text(
-                "✅ اختر القناة أو الكروب لقبول طلبات الانضمام:",
-                reply_markup=get_channels_keyboard(channels, "choose")
-            )
-    
-    elif data.startswith("choose_"):
-        chat_id = int(data.split("_")[1])
-        channel = db.get_channel(user_id, chat_id)
-        if channel:
-            await query.edit_message_text(
-                f"📊 {channel['title']}\n\n"
-                "كم عدد طلبات الانضمام الذي تريد قبوله؟ اختر العدد\n"
-                "او يمكنك قبول جميع الطلبات",
-                reply_markup=get_accept_count_keyboard(chat_id)
-            )
-    
-    elif data.startswith("manage_"):
-        chat_id = int(data.split("_")[1])
-        channel = db.get_channel(user_id, chat_id)
-        if channel:
-            ch_type = "قناة" if channel['chat_type'] == 'channel' else "كروب"
-            auto_status = "مفعل ✅" if channel['auto_accept'] else "معطل ❌"
-            await query.edit_message_text(
-                f"📋 {channel['title']}\n"
-                f"النوع: {ch_type}\n"
-                f"القبول التلقائي: {auto_status}",
-                reply_markup=get_channel_actions_keyboard(chat_id)
-            )
-    
-    elif data.startswith("channel_accept_"):
-        chat_id = int(data.split("_")[2])
-        channel = db.get_channel(user_id, chat_id)
-        if channel:
-            await query.edit_message_text(
-                f"📊 {channel['title']}\n\n"
-                "كم عدد طلبات الانضمام الذي تريد قبوله؟ اختر العدد\n"
-                "او يمكنك قبول جميع الطلبات",
-                reply_markup=get_accept_count_keyboard(chat_id)
-            )
-    
-    elif data.startswith("auto_accept_"):
-        chat_id = int(data.split("_")[2])
-        new_status = db.toggle_auto_accept(user_id, chat_id)
-        status_text = "مفعل ✅" if new_status else "معطل ❌"
-        await query.answer(f"القبول التلقائي: {status_text}", show_alert=True)
-        
-        channel = db.get_channel(user_id, chat_id)
-        if channel:
-            ch_type = "قناة" if channel['chat_type'] == 'channel' else "كروب"
-            await query.edit_message_text(
-                f"📋 {channel['title']}\n"
-                f"النوع: {ch_type}\n"
-                f"القبول التلقائي: {status_text}",
-                reply_markup=get_channel_actions_keyboard(chat_id)
-            )
-    
-    elif data.startswith("delete_channel_"):
-        chat_id = int(data.split("_")[2])
-        db.delete_channel(user_id, chat_id)
-        await query.answer("✅ تم الحذف بنجاح", show_alert=True)
-        
-        channels = db.get_user_channels(user_id)
-        if not channels:
-            await query.edit_message_text(
-                "❌ لا توجد قنوات أو مجموعات مضافة",
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            text = "📋 قنواتي وكروباتي:\n\n"
-            for ch in channels:
-                ch_type = "📢" if ch['chat_type'] == 'channel' else "👥"
-                text += f"{ch_type} {ch['title']}\n"
-            await query.edit_message_text(
-                text,
-                reply_markup=get_channels_keyboard(channels, "manage")
-            )
-    
-    elif data.startswith("accept_"):
-        parts = data.split("_")
-        if parts[1] == "all":
-            count = None
-            chat_id = int(parts[2])
-        else:
-            count = int(parts[1])
-            chat_id = int(parts[2])
-        
-        await query.edit_message_text("⏳ جاري قبول الطلبات...")
-        
-        accepted = await accept_join_requests(context.bot, chat_id, count)
-        
-        await query.edit_message_text(
-            f"✅ تم قبول {accepted} طلب انضمام بنجاح!",
-            reply_markup=get_main_keyboard()
-        )
-    
-    elif data == "back_main":
-        user_states.pop(user_id, None)
-        user = update.effective_user
-        welcome_text = f"""👋❤️ مرحبا {user.first_name}
+
+@router.route(callbacks.DELETE_CHANNEL, int, answer=False)
+async def delete_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Delete a channel and show the remaining ones"""
+    user_id = update.effective_user.id
+    await db.delete_channel(user_id, chat_id)
+    await update.callback_query.answer("✅ تم الحذف بنجاح", show_alert=True)
+    await show_channels(update.callback_query, user_id, callbacks.MY_CHANNELS)
+
+@router.route(callbacks.ACCEPT, callbacks.count_or_all, int, answer=False)
+async def start_accept_job(update: Update, context: ContextTypes.DEFAULT_TYPE, count, chat_id):
+    """Start a background approval job for `count` requests (None for all)"""
+    query = update.callback_query
+    message = query.message
+    # The payload comes from the client: only the chat's owners may start a job for it
+    if not await db.get_channel(update.effective_user.id, chat_id):
+        await query.answer("❌ هذه القناة ليست ضمن قنواتك", show_alert=True)
+        return
+    if approval_jobs.at_quota(update.effective_user.id):
+        await query.answer("⚠️ لديك عدة عمليات قبول جارية، انتظر انتهاء إحداها", show_alert=True)
+        return
+    job_id = await approval_jobs.start(
+        context.bot, update.effective_user.id, chat_id, count, message.chat_id, message.message_id
+    )
+    if job_id is None:
+        await query.answer("⚠️ يوجد عملية قبول جارية لهذه القناة", show_alert=True)
+    else:
+        # The job edits the message into its progress view itself
+        await query.answer()
+
+@router.route(callbacks.CANCEL_JOB, int, answer=False)
+async def cancel_accept_job(update: Update, context: ContextTypes.DEFAULT_TYPE, job_id):
+    """Ask a running approval job to stop"""
+    query = update.callback_query
+    if approval_jobs.cancel(job_id, update.effective_user.id):
+        await query.answer("⏹ سيتم إيقاف العملية بعد الدفعة الحالية", show_alert=True)
+    else:
+        await query.answer("❌ لا توجد عملية جارية", show_alert=True)
+
+@router.route(callbacks.BACK_MAIN)
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Back to the main menu"""
+    user = update.effective_user
+    user_states.pop(user.id, None)
+    welcome_text = f"""👋❤️ مرحبا {user.first_name}
 • بوت قبول طلبات الانضمام الخاصة بالقنوات والكروبات✅.
 
 لتفعيل البوت:
@@ -252,52 +289,95 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 3. ستظهر القناة في قائمة "قنواتي وكروباتي"
 
 يمكنك قبول الطلبات بشكل تلقائي مباشرةً او تخزينها لقبولها لاحقاً بنقرة زر من خلال البوت 🤖"""
-        
-        await query.edit_message_text(
-            welcome_text,
-            reply_markup=get_main_keyboard()
-        )
+    
+    await update.callback_query.edit_message_text(
+        welcome_text,
+        reply_markup=get_main_keyboard()
+    )
 
+@timed_handler("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages in private chat"""
     pass
 
+@timed_handler("handle_chat_join_request")
 async def handle_chat_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming join requests - auto accept if enabled, otherwise store"""
+    """Handle incoming join requests - auto accept if enabled, otherwise store
+
+    A transient failure (flood wait, network) is retried from the retry queue;
+    any other failure keeps the request pending for a manual accept.
+    """
     request = update.chat_join_request
     chat_id = request.chat.id
     user_id = request.from_user.id
     first_name = request.from_user.first_name
     username = request.from_user.username
     
-    auto_channels = db.get_auto_accept_channels()
-    
-    auto_accepted = False
-    for channel in auto_channels:
-        if channel['chat_id'] == chat_id:
-            try:
-                await context.bot.approve_chat_join_request(chat_id, user_id)
-                auto_accepted = True
-            except TelegramError:
-                pass
-            break
+    if db.is_auto_accept(chat_id):
+        try:
+            # A flood wait goes to the retry queue instead of holding an update worker
+            await context.bot.approve_chat_join_request(
+                chat_id, user_id,
+                rate_limit_args=FAIL_FAST if context.bot.rate_limiter else None
+            )
+            return
+        except TelegramError as e:
+            if is_transient(e):
+                await retry_queue.defer(chat_id, user_id, first_name, username, e)
+                return
+            if cache.is_permission_error(e):
+                cache.invalidate(chat_id)
     
-    if not auto_accepted:
-        db.add_pending_request(chat_id, user_id, first_name, username)
+    await pending_writer.add(chat_id, user_id, first_name, username)
 
 async def accept_join_requests(bot, chat_id, count=None):
-    """Accept pending join requests for a chat"""
-    accepted = 0
-    
-    pending = db.get_pending_requests(chat_id, limit=count)
-    
-    for req in pending:
+    """Accept pending join requests for a chat and return the ApprovalStats"""
+    return await drain_pending(bot, chat_id, count)
+
+@timed_handler("profile_command")
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /profile [seconds] - profile the running bot (admins only)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    seconds = PROFILE_DEFAULT_SECONDS
+    if context.args:
         try:
-            await bot.approve_chat_join_request(chat_id, req['user_id'])
-            db.delete_pending_request(chat_id, req['user_id'])
-            accepted += 1
-        except TelegramError:
-            db.delete_pending_request(chat_id, req['user_id'])
-            pass
-    
-    return accepted
+            seconds = float(context.args[0])
+        except ValueError:
+            seconds = math.nan
+        # "nan" and "inf" parse as floats, but asyncio.sleep(nan) never returns
+        if not math.isfinite(seconds):
+            await update.message.reply_text("❌ الاستخدام: /profile [عدد الثواني]")
+            return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+    if profiler.running:
+        await update.message.reply_text("⏳ يوجد تحليل أداء قيد التشغيل بالفعل.")
+        return
+
+    await update.message.reply_text(f"🔬 بدأ تحليل الأداء لمدة {seconds:g} ثانية...")
+    context.application.create_task(
+        send_profile(context.bot, update.effective_chat.id, seconds), update=update
+    )
+
+async def send_profile(bot, chat_id, seconds):
+    """Profile the bot for `seconds` and send the hottest functions and a .prof dump"""
+    result = await profiler.profile(seconds)
+    if result is None:
+        await bot.send_message(chat_id, "⏳ يوجد تحليل أداء قيد التشغيل بالفعل.")
+        return
+
+    header = f"🔬 نتيجة تحليل الأداء ({result.seconds:.0f} ثانية):\n\n"
+    # Escaping lengthens "<listcomp>", "<frozen ...>" etc.: drop the least busy rows
+    # until the escaped table fits under Telegram's 4096-character limit
+    rows = html.escape(result.top(PROFILE_TOP_FUNCTIONS)).splitlines()
+    while rows and len(header) + len("\n".join(rows)) + len("<pre></pre>") > 4000:
+        rows.pop()
+    await bot.send_message(chat_id, header + "<pre>" + "\n".join(rows) + "</pre>", parse_mode="HTML")
+    await bot.send_document(
+        chat_id,
+        result.dump(),
+        filename=f"profile-{time.strftime('%Y%m%d-%H%M%S')}.prof",
+        caption="📄 ملف التحليل الكامل (pstats)"
+    )
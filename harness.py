@@ -0,0 +1,233 @@
+"""
+Offline test harness: a local stand-in for the Telegram Bot API and helpers
+for building synthetic updates and a scratch database.
+
+FakeBotAPI plugs into python-telegram-bot as its request backend
+(telegram.request.BaseRequest), so the real Application, ExtBot and handlers
+run unchanged while no request ever leaves the process.
+"""
+
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+from telegram.error import NetworkError
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+import database
+from memory_storage import MemoryStorage
+from storage import SQLiteStorage, set_storage
+
+FAKE_TOKEN = "123456:FAKE-TOKEN"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+
+
+# Methods that never get injected latency or errors
+_SETUP_ENDPOINTS = {"getMe", "getUpdates", "setWebhook", "deleteWebhook"}
+
+
+class FakeBotAPI(BaseRequest):
+    """In-process Bot API: answers every method and serves queued updates to getUpdates
+
+    latency: seconds each call takes; error_rate: share of calls answered with a
+    400 Bad Request; retry_after_rate: share answered with 429 Too Many Requests
+    asking to retry after `retry_after` seconds; network_error_rate: share that
+    fail with a NetworkError before reaching the API.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after_rate=0.0, retry_after=1,
+                 seed=None, network_error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.network_error_rate = network_error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = {}           # endpoint -> number of calls
+        self.errors = {}          # injected error kind -> count
+        self.on_call = None       # optional callback(endpoint, params)
+        self._updates = []
+        self._update_event = None
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 10.0
+
+    def push_update(self, update):
+        """Queue an update dict for the next getUpdates call"""
+        self._updates.append(update)
+        if self._update_event is not None:
+            self._update_event.set()
+
+    async def do_request(self, url, method, request_data: RequestData = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.on_call is not None:
+            self.on_call(endpoint, params)
+
+        if endpoint not in _SETUP_ENDPOINTS:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            roll = self.random.random()
+            if roll < self.retry_after_rate:
+                self.errors["retry_after"] = self.errors.get("retry_after", 0) + 1
+                return 429, json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+            if roll < self.retry_after_rate + self.error_rate:
+                self.errors["bad_request"] = self.errors.get("bad_request", 0) + 1
+                return 400, json.dumps({
+                    "ok": False, "error_code": 400,
+                    "description": "Bad Request: HIDE_REQUESTER_MISSING",
+                }).encode()
+            if roll < self.retry_after_rate + self.error_rate + self.network_error_rate:
+                self.errors["network"] = self.errors.get("network", 0) + 1
+                raise NetworkError("Fake connection reset")
+
+        if endpoint == "getUpdates":
+            result = await self._get_updates(params)
+        else:
+            result = self.result_for(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    async def _get_updates(self, params):
+        offset = params.get("offset") or 0
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and params.get("timeout"):
+            if self._update_event is None:
+                self._update_event = asyncio.Event()
+            self._update_event.clear()
+            try:
+                await asyncio.wait_for(self._update_event.wait(), params["timeout"])
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:params.get("limit") or 100]
+
+    def result_for(self, endpoint, params):
+        """Canned successful result for a Bot API method"""
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "getChatMember":
+            return {"status": "creator", "is_anonymous": False,
+                    "user": make_user(params.get("user_id", 1))}
+        if endpoint == "getChat":
+            return {"id": params.get("chat_id", 1), "type": "channel", "title": "Channel",
+                    "accent_color_id": 0, "max_reaction_count": 11,
+                    "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                            "unique_gifts": False, "premium_subscription": False,
+                                            "gifts_from_channels": False}}
+        if endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = params.get("chat_id", 1)
+            return {"message_id": params.get("message_id") or next(self._message_ids),
+                    "date": int(time.time()), "text": params.get("text", ""),
+                    "chat": {"id": chat_id, "type": "private" if int(chat_id) > 0 else "channel"}}
+        return True
+
+
+def make_application(api=None, rate_limiter=None):
+    """Build the bot's Application on top of a FakeBotAPI
+
+    rate_limiter: as for bot.build_application (False runs unthrottled)
+    """
+    import bot
+    api = api or FakeBotAPI()
+    builder = (
+        Application.builder()
+        .token(FAKE_TOKEN)
+        .request(api)
+        .get_updates_request(api)
+    )
+    return bot.build_application(builder, rate_limiter, record=False), api
+
+
+def use_scratch_db(path=None, backend="sqlite"):
+    """Point database.py at a throwaway file and create the schema
+
+    backend: "memory" keeps users, channels and pending requests in a
+    MemoryStorage that is not persisted
+    """
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="bot_bench_"), "bot_data.db")
+    database.close_connection()
+    database.DB_PATH = path
+    database.init_db()
+    set_storage(MemoryStorage() if backend == "memory" else SQLiteStorage()).open()
+    return path
+
+
+_update_ids = itertools.count(1)
+
+
+def make_user(user_id, first_name=None):
+    return {"id": user_id, "is_bot": False, "first_name": first_name or f"User{user_id}"}
+
+
+def make_join_request(chat_id, user_id):
+    """Synthetic chat_join_request update"""
+    return {
+        "update_id": next(_update_ids),
+        "chat_join_request": {
+            "chat": {"id": chat_id, "type": "channel", "title": "Channel"},
+            "from": make_user(user_id),
+            "user_chat_id": user_id,
+            "date": int(time.time()),
+        },
+    }
+
+
+def make_callback_query(user_id, data, message_id=1):
+    """Synthetic callback_query update from a private chat"""
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "text": "menu",
+                        "chat": {"id": user_id, "type": "private"}},
+        },
+    }
+
+
+def make_command(user_id, text):
+    """Synthetic private /command message update"""
+    command = text.split()[0]
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of a list of numbers, nearest-rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
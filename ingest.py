@@ -0,0 +1,157 @@
+"""
+Write-behind buffer between handle_chat_join_request and pending_requests.
+
+Join requests are queued in memory and written with a single executemany
+transaction every PENDING_FLUSH_ROWS rows or PENDING_FLUSH_INTERVAL seconds,
+whichever comes first. The buffer is bounded: once PENDING_BUFFER_SIZE rows
+are waiting, handlers wait for the next flush instead of growing memory.
+"""
+
+import asyncio
+import logging
+
+import async_db as db
+from config import PENDING_BUFFER_SIZE, PENDING_FLUSH_ROWS, PENDING_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Queue marker that tells the writer loop to exit after a final flush
+_STOP = object()
+
+
+class PendingWriter:
+    """Buffered, batched writer for pending join requests"""
+
+    # Used in log messages and the task name
+    rows_name = "pending requests"
+    task_name = "pending_writer"
+
+    def __init__(self, max_buffer=PENDING_BUFFER_SIZE, flush_rows=PENDING_FLUSH_ROWS,
+                 flush_interval=PENDING_FLUSH_INTERVAL):
+        self.max_buffer = max_buffer
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._task = None
+        self._failed = False  # a write failed since the last flush() was answered
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    @property
+    def buffered(self):
+        """Number of queued requests not yet handed to the database"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        """Start the background flush loop on the running event loop"""
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_buffer)
+            self._task = asyncio.create_task(self._run(), name=self.task_name)
+
+    async def stop(self):
+        """Flush everything still buffered and stop the loop"""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        self._queue = None
+
+    async def add(self, chat_id, user_id, first_name, username):
+        """Queue a pending request (written directly when the writer is not running)"""
+        await self.put((chat_id, user_id, first_name, username))
+
+    async def put(self, row):
+        """Queue a row for the next batch (written directly when the writer is not running)"""
+        if self._task is None:
+            await self._store([row])
+        else:
+            await self._queue.put(row)
+
+    async def flush(self):
+        """Wait until every row queued so far has been written
+
+        Returns False if a write failed since the previous flush, i.e. some of
+        those rows are not in the database.
+        """
+        if self._task is None:
+            return True
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put(done)
+        return await done
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            waiters = []
+            deadline = loop.time() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                if isinstance(item, asyncio.Future):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.flush_rows:
+                    break
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if batch:
+                if not await self._write(batch):
+                    self._failed = True
+                batch = []
+            if waiters:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(not self._failed)
+                self._failed = False
+
+    async def _store(self, rows):
+        """Write one batch; returns False if the database reported a failure"""
+        return await db.add_pending_requests(rows)
+
+    async def _write(self, batch):
+        """Write one batch, logging failures; returns True if it was written"""
+        try:
+            if await self._store(batch):
+                return True
+            logger.error("Failed to write %d %s", len(batch), self.rows_name)
+        except Exception:
+            logger.exception("Failed to write %d %s", len(batch), self.rows_name)
+        return False
+
+
+# Shared writer used by the handlers
+pending_writer = PendingWriter()
+
+# Replaces the local flush in flush_chat (multi-process mode, see sharding.py)
+_chat_flusher = None
+
+
+def set_chat_flusher(flusher):
+    """Install an async flusher(chat_id) -> bool for flush_chat"""
+    global _chat_flusher
+    _chat_flusher = flusher
+
+
+async def flush_chat(chat_id):
+    """Wait until the join requests buffered for a chat so far are written
+
+    In multi-process mode they are buffered by the worker that owns the chat,
+    which need not be this one. Returns False if some could not be written.
+    """
+    if _chat_flusher is not None:
+        return await _chat_flusher(chat_id)
+    return await pending_writer.flush()
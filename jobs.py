@@ -0,0 +1,213 @@
+"""
+Background approval jobs.
+
+An "accept" button starts a job instead of approving inside the callback.
+Each job drains pending requests batch by batch (approvals.drain_pending),
+saves a checkpoint in approval_jobs after every batch, edits its progress
+message at most every JOB_PROGRESS_INTERVAL seconds and can be cancelled by
+its owner. Jobs still marked 'running' are resumed when the bot restarts;
+a job that raises is marked 'failed' (not resumed) and its owner is told.
+Batches are approved when the fair scheduler (scheduler.py) gives the job a
+turn, and the progress message shows the job's place in line and its ETA.
+"""
+
+import asyncio
+import logging
+
+from telegram.error import TelegramError
+
+import async_db as db
+from approvals import ApprovalStats, drain_pending
+from config import JOB_PROGRESS_INTERVAL, JOB_SHUTDOWN_GRACE
+from ingest import flush_chat
+from keyboards import get_main_keyboard, get_job_keyboard
+from scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def format_approval_stats(stats):
+    """Summary text for a finished approval run"""
+    text = f"✅ تم قبول {stats.accepted} طلب انضمام بنجاح!"
+    if stats.failed:
+        text += f"\n❌ فشل: {stats.failed}"
+    if stats.retried:
+        text += f"\n🔄 إعادة محاولة: {stats.retried}"
+    if stats.deferred:
+        text += f"\n⏳ مؤجل لإعادة المحاولة تلقائياً: {stats.deferred}"
+    return text
+
+
+def format_duration(seconds):
+    """Rough Arabic duration for an ETA"""
+    minutes = round(seconds / 60)
+    if minutes < 1:
+        return "أقل من دقيقة"
+    if minutes < 60:
+        return f"{minutes} دقيقة"
+    return f"{minutes // 60} ساعة و{minutes % 60} دقيقة"
+
+
+def format_progress(stats, processed, requested, position=None, eta=None):
+    """Progress text for a running approval job
+
+    position: place in the scheduler's line (0 while approving); eta: seconds left
+    """
+    text = (
+        "⏳ جاري قبول الطلبات...\n\n"
+        f"✅ مقبول: {stats.accepted}\n"
+        f"❌ فشل: {stats.failed}\n"
+        f"📊 {processed}/{requested}"
+    )
+    if position:
+        text += f"\n🚦 بانتظار الدور: {position}"
+    if eta is not None:
+        text += f"\n🕒 الوقت المتبقي تقريباً: {format_duration(eta)}"
+    return text
+
+
+class ApprovalJobManager:
+    """Starts, tracks, cancels and resumes approval jobs"""
+
+    def __init__(self):
+        self._tasks = {}        # job_id -> asyncio.Task
+        self._chats = {}        # job_id -> chat_id
+        self._owners = {}       # job_id -> owner user_id
+        self._cancelled = set()
+        self._starting = set()  # chat_ids whose job is being created
+        self._stopping = False
+
+    def is_running(self, chat_id):
+        return chat_id in self._starting or chat_id in self._chats.values()
+
+    def at_quota(self, owner_id):
+        """True if the owner already runs SCHEDULER_MAX_JOBS_PER_OWNER jobs"""
+        return scheduler.at_quota(owner_id)
+
+    async def start(self, bot, owner_id, chat_id, count, message_chat_id, message_id):
+        """Start a job for `count` requests (all when None); None if one is already running"""
+        if self.is_running(chat_id):
+            return None
+        # Updates are processed concurrently: reserve the chat before the first await
+        self._starting.add(chat_id)
+        try:
+            if count is None:
+                # Snapshot the backlog so "all" has a fixed target to report against
+                await flush_chat(chat_id)
+                count = await db.get_pending_count(chat_id)
+            job_id = await db.create_approval_job(owner_id, chat_id, count, message_chat_id, message_id)
+            self._spawn(bot, await db.get_approval_job(job_id))
+        finally:
+            self._starting.discard(chat_id)
+        return job_id
+
+    def cancel(self, job_id, owner_id):
+        """Ask a running job to stop after its current batch"""
+        if job_id not in self._tasks or self._owners.get(job_id) != owner_id:
+            return False
+        self._cancelled.add(job_id)
+        return True
+
+    async def resume(self, bot):
+        """Restart jobs that were running when the bot stopped"""
+        for job in await db.get_running_approval_jobs():
+            if job['id'] not in self._tasks:
+                logger.info("Resuming approval job %s at %s/%s",
+                            job['id'], job['processed'], job['requested'])
+                self._spawn(bot, job)
+
+    async def stop(self, grace=JOB_SHUTDOWN_GRACE):
+        """Let running batches checkpoint, then cancel; jobs stay 'running' for resume"""
+        self._stopping = True
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, still_running = await asyncio.wait(tasks, timeout=grace)
+        for task in still_running:
+            task.cancel()
+        await asyncio.gather(*still_running, return_exceptions=True)
+
+    def _spawn(self, bot, job):
+        job_id = job['id']
+        self._chats[job_id] = job['chat_id']
+        self._owners[job_id] = job['owner_id']
+        scheduler.register(job_id, job['owner_id'], (job['requested'] or 0) - job['processed'])
+        task = asyncio.create_task(self._run(bot, job), name=f"approval_job_{job_id}")
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._forget(job_id))
+
+    def _forget(self, job_id):
+        self._tasks.pop(job_id, None)
+        self._chats.pop(job_id, None)
+        self._owners.pop(job_id, None)
+        self._cancelled.discard(job_id)
+        scheduler.unregister(job_id)
+
+    async def _run(self, bot, job):
+        job_id = job['id']
+        requested = job['requested'] or 0
+        done_before = done = job['processed']
+        totals = ApprovalStats(job['accepted'], job['failed'], job['retried'])
+
+        async def on_batch(batch, processed):
+            nonlocal done
+            totals.add(batch)
+            done = done_before + processed
+            scheduler.set_remaining(job_id, requested - done)
+            await db.update_approval_job(job_id, done, totals.accepted, totals.failed, totals.retried)
+
+        async def report_progress(shown):
+            # Also runs while the job waits for its turn, so the place in line stays current
+            while True:
+                await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+                text = format_progress(totals, done, requested, *scheduler.status(job_id))
+                if text != shown:
+                    shown = text
+                    await self._edit(bot, job, text, get_job_keyboard(job_id))
+
+        def should_stop():
+            return self._stopping or job_id in self._cancelled
+
+        # The job posts its first progress message itself: every edit of the
+        # message then comes from this task, so the result is never overwritten
+        text = format_progress(totals, done, requested, *scheduler.status(job_id))
+        await self._edit(bot, job, text, get_job_keyboard(job_id))
+        reporter = asyncio.create_task(report_progress(text))
+        try:
+            await drain_pending(bot, job['chat_id'], requested - done_before,
+                                on_batch=on_batch, should_stop=should_stop,
+                                turn=lambda wanted: scheduler.turn(job_id, wanted))
+        except Exception:
+            # Not resumed on restart, so a job that keeps failing does not keep retrying
+            logger.exception("Approval job %s failed", job_id)
+            status = 'failed'
+        else:
+            if self._stopping and job_id not in self._cancelled:
+                return  # shutting down: leave the job 'running' so it resumes
+            status = 'cancelled' if job_id in self._cancelled else 'done'
+        finally:
+            reporter.cancel()
+
+        await db.update_approval_job(job_id, done, totals.accepted, totals.failed,
+                                     totals.retried, status)
+        text = format_approval_stats(totals)
+        if status == 'cancelled':
+            text = "⏹ تم إيقاف العملية\n" + text
+        elif status == 'failed':
+            text = "⚠️ توقفت العملية بسبب خطأ، يمكنك المحاولة مرة أخرى\n" + text
+        await self._edit(bot, job, text, get_main_keyboard())
+
+    async def _edit(self, bot, job, text, reply_markup):
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=job['message_chat_id'],
+                message_id=job['message_id'],
+                reply_markup=reply_markup
+            )
+        except TelegramError:
+            pass
+
+
+# Shared manager used by the handlers
+approval_jobs = ApprovalJobManager()
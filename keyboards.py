@@ -1,71 +1,101 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from callbacks import (
+    encode, ADD_CHAT, MY_CHANNELS, ACCEPT_REQUESTS, CHOOSE, CHANNEL_ACCEPT, AUTO_ACCEPT,
+    DELETE_CHANNEL, ACCEPT, CANCEL_JOB, BACK_MAIN
+)
+
+# Markups are immutable, so identical ones are built once and shared
+
+@lru_cache(maxsize=None)
 def get_main_keyboard():
     """Main menu keyboard - القائمة الرئيسية"""
     keyboard = [
         [
-            InlineKeyboardButton("• إضافة قناة •", callback_data="add_channel"),
-            InlineKeyboardButton("• إضافة كروب •", callback_data="add_group")
+            InlineKeyboardButton("• إضافة قناة •", callback_data=encode(ADD_CHAT)),
+            InlineKeyboardButton("• إضافة كروب •", callback_data=encode(ADD_CHAT))
         ],
         [
-            InlineKeyboardButton("• قنواتي وكروباتي •", callback_data="my_channels")
+            InlineKeyboardButton("• قنواتي وكروباتي •", callback_data=encode(MY_CHANNELS))
         ],
         [
-            InlineKeyboardButton("✅ موافق على الانضمام", callback_data="accept_requests")
+            InlineKeyboardButton("✅ موافق على الانضمام", callback_data=encode(ACCEPT_REQUESTS))
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_channels_keyboard(channels, action="select"):
-    """Keyboard to display user's channels/groups"""
+def get_channels_keyboard(channels, action=CHOOSE, page=0, has_next=False, page_action=ACCEPT_REQUESTS):
+    """Keyboard to display one page of user's channels/groups (with pending counts when known)
+
+    action: route of the channel buttons; page_action: route of the previous/next buttons
+    """
     keyboard = []
     for channel in channels:
         channel_name = channel['title']
         channel_id = channel['chat_id']
+        label = f"✅ {channel_name}"
+        if 'pending_count' in channel:
+            label += f" ({channel['pending_count']})"
         keyboard.append([InlineKeyboardButton(
-            f"✅ {channel_name}", 
-            callback_data=f"{action}_{channel_id}"
+            label, 
+            callback_data=encode(action, channel_id)
         )])
-    keyboard.append([InlineKeyboardButton("• رجوع •", callback_data="back_main")])
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ السابق", callback_data=encode(page_action, page - 1)))
+    if has_next:
+        navigation.append(InlineKeyboardButton("التالي ▶️", callback_data=encode(page_action, page + 1)))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("• رجوع •", callback_data=encode(BACK_MAIN))])
     return InlineKeyboardMarkup(keyboard)
 
-def get_accept_count_keyboard(chat_id):
-    """Keyboard for selecting number of requests to accept"""
-    keyboard = [
-        [
-            InlineKeyboardButton("10", callback_data=f"accept_10_{chat_id}"),
-            InlineKeyboardButton("50", callback_data=f"accept_50_{chat_id}"),
-            InlineKeyboardButton("100", callback_data=f"accept_100_{chat_id}"),
-            InlineKeyboardButton("250", callback_data=f"accept_250_{chat_id}"),
-            InlineKeyboardButton("500", callback_data=f"accept_500_{chat_id}")
-        ],
-        [
-            InlineKeyboardButton("1000", callback_data=f"accept_1000_{chat_id}"),
-            InlineKeyboardButton("5000", callback_data=f"accept_5000_{chat_id}"),
-            InlineKeyboardButton("10000", callback_data=f"accept_10000_{chat_id}"),
-            InlineKeyboardButton("50000", callback_data=f"accept_50000_{chat_id}"),
-            InlineKeyboardButton("100000", callback_data=f"accept_100000_{chat_id}")
-        ],
-        [
-            InlineKeyboardButton("• قبول كل الطلبات المعلقة", callback_data=f"accept_all_{chat_id}")
-        ],
-        [
-            InlineKeyboardButton("• رجوع •", callback_data="accept_requests")
-        ]
-    ]
+# Preset amounts offered on the accept keyboard
+ACCEPT_COUNTS = [10, 50, 100, 250, 500, 1000, 5000, 10000, 50000, 100000]
+
+@lru_cache(maxsize=1024)
+def _accept_count_rows(chat_id, offered):
+    """Rows of the first `offered` preset buttons (the backlog count changes too often to cache)"""
+    counts = ACCEPT_COUNTS[:offered]
+    return tuple(
+        tuple(InlineKeyboardButton(str(n), callback_data=encode(ACCEPT, n, chat_id)) for n in counts[i:i + 5])
+        for i in range(0, len(counts), 5)
+    )
+
+def get_accept_count_keyboard(chat_id, pending=None):
+    """Keyboard for selecting number of requests to accept
+
+    pending: current backlog; only amounts below it are offered (all presets when None)
+    """
+    offered = sum(1 for n in ACCEPT_COUNTS if pending is None or n < pending)
+    keyboard = list(_accept_count_rows(chat_id, offered))
+    if pending != 0:
+        label = "• قبول كل الطلبات المعلقة" + (f" ({pending})" if pending else "")
+        keyboard.append([InlineKeyboardButton(label, callback_data=encode(ACCEPT, "all", chat_id))])
+    keyboard.append([InlineKeyboardButton("• رجوع •", callback_data=encode(ACCEPT_REQUESTS))])
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_back_keyboard():
     """Simple back button"""
-    keyboard = [[InlineKeyboardButton("• رجوع •", callback_data="back_main")]]
+    keyboard = [[InlineKeyboardButton("• رجوع •", callback_data=encode(BACK_MAIN))]]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1024)
 def get_channel_actions_keyboard(chat_id):
     """Actions for a specific channel"""
     keyboard = [
-        [InlineKeyboardButton("✅ قبول الطلبات", callback_data=f"channel_accept_{chat_id}")],
-        [InlineKeyboardButton("🔄 تفعيل القبول التلقائي", callback_data=f"auto_accept_{chat_id}")],
-        [InlineKeyboardButton("🗑 حذف", callback_data=f"delete_channel_{chat_id}")],
-        [InlineKeyboardButton("• رجوع •", callback_data="my_channels")]
+        [InlineKeyboardButton("✅ قبول الطلبات", callback_data=encode(CHANNEL_ACCEPT, chat_id))],
+        [InlineKeyboardButton("🔄 تفعيل القبول التلقائي", callback_data=encode(AUTO_ACCEPT, chat_id))],
+        [InlineKeyboardButton("🗑 حذف", callback_data=encode(DELETE_CHANNEL, chat_id))],
+        [InlineKeyboardButton("• رجوع •", callback_data=encode(MY_CHANNELS))]
     ]
     return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=256)
+def get_job_keyboard(job_id):
+    """Cancel button for a running approval job"""
+    keyboard = [[InlineKeyboardButton("⏹ إيقاف", callback_data=encode(CANCEL_JOB, job_id))]]
+    return InlineKeyboardMarkup(keyboard)
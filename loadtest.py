@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Local load test: polling vs webhook update delivery.
+
+Runs the real Application (handlers, DB writer, scratch database) against the
+in-process FakeBotAPI and floods it with synthetic chat_join_request updates
+for an auto-accept channel. In polling mode the updates are served through
+getUpdates; in webhook mode they are POSTed to the embedded webhook server
+with the secret token header. End-to-end latency is measured from delivery
+to the moment the matching approveChatJoinRequest reaches the fake API.
+The API rate governor is off unless --rate-limit is given.
+
+    python loadtest.py --mode polling --count 20000
+    python loadtest.py --mode webhook --count 20000 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+import httpx
+
+import bot
+import harness
+from storage import get_storage
+
+CHAT_ID = -1001000000001
+OWNER_ID = 1
+FIRST_USER_ID = 10_000_000
+
+
+async def run(mode, count, concurrency, port, rate_limit):
+    harness.use_scratch_db()
+    get_storage().add_channel(OWNER_ID, CHAT_ID, "Load test", "channel")
+    get_storage().toggle_auto_accept(OWNER_ID, CHAT_ID)
+
+    application, api = harness.make_application(rate_limiter=None if rate_limit else False)
+    sent_at = {}
+    latencies = []
+    finished = asyncio.Event()
+
+    def on_call(endpoint, params):
+        if endpoint == "approveChatJoinRequest":
+            latencies.append(time.perf_counter() - sent_at[int(params["user_id"])])
+            if len(latencies) >= count:
+                finished.set()
+
+    api.on_call = on_call
+
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+
+    updates = [harness.make_join_request(CHAT_ID, FIRST_USER_ID + i) for i in range(count)]
+    started = time.perf_counter()
+
+    if mode == "polling":
+        await application.updater.start_polling(poll_interval=0, timeout=10,
+                                                allowed_updates=bot.ALLOWED_UPDATES)
+        for update in updates:
+            sent_at[update["chat_join_request"]["from"]["id"]] = time.perf_counter()
+            api.push_update(update)
+    else:
+        settings = bot.webhook_settings(port=port, webhook_url=None)
+        await application.updater.start_webhook(**settings)
+        url = f"http://127.0.0.1:{port}/{settings['url_path']}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": settings["secret_token"]}
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            rejected = await client.post(url, json=updates[0],
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+            print(f"wrong secret token -> HTTP {rejected.status_code}")
+
+            pending = iter(updates)
+
+            async def sender():
+                for update in pending:
+                    sent_at[update["chat_join_request"]["from"]["id"]] = time.perf_counter()
+                    await client.post(url, json=update, headers=headers)
+
+            await asyncio.gather(*(sender() for _ in range(concurrency)))
+
+    try:
+        await asyncio.wait_for(finished.wait(), timeout=max(60, count / 100))
+    except asyncio.TimeoutError:
+        print(f"timed out: {len(latencies)}/{count} approvals seen")
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+    print(f"mode:        {mode}")
+    print(f"updates:     {count}")
+    print(f"elapsed:     {elapsed:.2f}s")
+    print(f"throughput:  {len(latencies) / elapsed:.0f} updates/s")
+    for q in (50, 90, 99):
+        print(f"p{q} latency: {harness.percentile(latencies, q) * 1000:.1f} ms")
+    print(f"max latency: {max(latencies, default=0) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--count", type=int, default=10000, help="join requests to send")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="parallel HTTP connections (webhook mode)")
+    parser.add_argument("--port", type=int, default=18443, help="local webhook port")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the API rate governor on (measures the API ceiling instead)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args.mode, args.count, args.concurrency, args.port, args.rate_limit))
+
+
+if __name__ == "__main__":
+    main()
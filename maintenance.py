@@ -0,0 +1,75 @@
+"""
+Background maintenance of the database.
+
+Every MAINTENANCE_INTERVAL seconds pending requests older than
+PENDING_TTL_DAYS are deleted in batches of MAINTENANCE_BATCH_SIZE rows (one
+short transaction each, so handlers keep getting the DB thread in between),
+then the freed pages are returned to the filesystem with an incremental
+vacuum. Requests that old were usually cancelled by the user or are no longer
+valid for Telegram, so approving them would only waste API calls. Expiry is
+opt-in: with PENDING_TTL_DAYS = 0 (the default) nothing is deleted and only
+the pages freed by approvals are compacted.
+"""
+
+import asyncio
+import logging
+
+import async_db as db
+import metrics
+from config import PENDING_TTL_DAYS, MAINTENANCE_INTERVAL, MAINTENANCE_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    """Periodic expiry of stale pending requests and database compaction"""
+
+    def __init__(self, ttl_days=PENDING_TTL_DAYS, interval=MAINTENANCE_INTERVAL,
+                 batch_size=MAINTENANCE_BATCH_SIZE):
+        self.ttl_days = ttl_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        """Start the maintenance loop on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="maintenance")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_once(self):
+        """Expire stale pending requests and compact; returns (rows expired, pages freed)"""
+        expired = 0
+        while self.ttl_days:
+            deleted = await db.expire_pending_requests(self.ttl_days * 86400, self.batch_size)
+            expired += deleted
+            if deleted < self.batch_size:
+                break
+        freed = await db.incremental_vacuum()
+        metrics.PENDING_EXPIRED.inc(amount=expired)
+        metrics.DB_PAGES_FREED.inc(amount=freed)
+        if expired or freed:
+            logger.info("Expired %d pending requests older than %s days, freed %d pages",
+                        expired, self.ttl_days, freed)
+        return expired, freed
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Database maintenance failed")
+            await asyncio.sleep(self.interval)
+
+
+# Shared maintenance loop started by bot.post_init
+maintenance = Maintenance()
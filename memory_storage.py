@@ -0,0 +1,303 @@
+"""
+In-memory storage backend (STORAGE_BACKEND = "memory").
+
+Users, channels and pending requests live in dicts; each chat's pending
+requests are an OrderedDict of user_id -> (id, first_name, username,
+created_at), oldest first, so counts are len() and draining a backlog
+never touches other chats.
+
+Persistence is a snapshot plus an append-only log: every change is applied
+in memory and appended to <snapshot>.aof as one JSON line (a batch of join
+requests is one line). Once MEMORY_SNAPSHOT_INTERVAL seconds have passed
+since the last snapshot, the next change writes a new snapshot and starts an
+empty log. On open the snapshot is loaded and the log replayed. A crash
+between writing a snapshot and truncating the log replays changes that are
+already in the snapshot: user, channel and delete entries are idempotent,
+and a replayed pending entry moves its requests to the end of their chat
+under new ids, which leaves the same requests in the same order (only the
+ids differ). The log is flushed after every line (a crash of the bot loses
+nothing; a crash of the machine may lose the last lines the OS had not
+written yet).
+"""
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from itertools import dropwhile, islice
+
+from config import MEMORY_SNAPSHOT_INTERVAL
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(seconds=None):
+    """UTC time formatted like SQLite's CURRENT_TIMESTAMP"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+class MemoryStorage(Storage):
+    """Users, channels and pending requests in memory
+
+    path: snapshot file (the log is path + ".aof"); None keeps nothing on disk
+    """
+
+    def __init__(self, path=None, snapshot_interval=MEMORY_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self._log = None
+        self._logged = 0              # log lines since the last snapshot
+        self._last_snapshot = time.monotonic()
+        self._reset()
+
+    def _reset(self):
+        self._users = {}              # user_id -> (username, first_name, created_at)
+        self._channels = {}           # user_id -> {chat_id: channel row}, in the order added
+        self._auto_accept = {}        # chat_id -> set of owner user_ids
+        self._pending = {}            # chat_id -> OrderedDict user_id -> (id, first_name, username, created_at)
+        self._next_channel_id = 1
+        self._next_pending_id = 1
+
+    # Persistence
+
+    @property
+    def log_path(self):
+        return self.path + '.aof'
+
+    def open(self):
+        self._reset()
+        if self.path is None:
+            return
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self._load_snapshot(json.load(f))
+        replayed = 0
+        line = '\n'
+        if os.path.exists(self.log_path):
+            with open(self.log_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op, *args = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        logger.warning("Skipping unreadable line in %s", self.log_path)
+                        continue
+                    getattr(self, '_apply_' + op)(*args)
+                    replayed += 1
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        if not line.endswith('\n'):
+            # Keep the next entry off the torn line
+            self._log.write('\n')
+        self._logged = replayed
+        logger.info("Loaded memory storage from %s (%d log entries replayed)", self.path, replayed)
+
+    def close(self):
+        if self._log is not None:
+            if self._logged:
+                self.snapshot()
+            self._log.close()
+            self._log = None
+
+    def snapshot(self):
+        """Write the whole state to the snapshot file and start an empty log"""
+        if self.path is None:
+            return
+        state = {
+            'users': [[user_id, *user] for user_id, user in self._users.items()],
+            'channels': [row for rows in self._channels.values() for row in rows.values()],
+            'pending': [[chat_id, [[user_id, *row] for user_id, row in rows.items()]]
+                        for chat_id, rows in self._pending.items()],
+            'next_channel_id': self._next_channel_id,
+            'next_pending_id': self._next_pending_id,
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, 'w', encoding='utf-8')
+        self._logged = 0
+        self._last_snapshot = time.monotonic()
+
+    def _load_snapshot(self, state):
+        for user_id, username, first_name, created_at in state['users']:
+            self._users[user_id] = (username, first_name, created_at)
+        for row in state['channels']:
+            self._channels.setdefault(row['user_id'], {})[row['chat_id']] = row
+            if row['auto_accept']:
+                self._auto_accept.setdefault(row['chat_id'], set()).add(row['user_id'])
+        for chat_id, rows in state['pending']:
+            self._pending[chat_id] = OrderedDict(
+                (user_id, tuple(row)) for user_id, *row in rows
+            )
+        self._next_channel_id = state['next_channel_id']
+        self._next_pending_id = state['next_pending_id']
+
+    def _write(self, op, *args):
+        """Apply a change and append it to the log"""
+        getattr(self, '_apply_' + op)(*args)
+        if self._log is None:
+            return
+        self._log.write(json.dumps([op, *args], ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._log.flush()
+        self._logged += 1
+        if time.monotonic() - self._last_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    # Log entries (also used to replay the log)
+
+    def _apply_user(self, user_id, username, first_name, created_at):
+        self._users[user_id] = (username, first_name, created_at)
+
+    def _apply_channel(self, channel_id, user_id, chat_id, title, chat_type, created_at):
+        rows = self._channels.setdefault(user_id, {})
+        if chat_id not in rows:
+            rows[chat_id] = {'id': channel_id, 'user_id': user_id, 'chat_id': chat_id,
+                             'title': title, 'chat_type': chat_type, 'auto_accept': 0,
+                             'created_at': created_at}
+            self._next_channel_id = max(self._next_channel_id, channel_id + 1)
+
+    def _apply_unchannel(self, user_id, chat_id):
+        rows = self._channels.get(user_id)
+        if rows is not None and rows.pop(chat_id, None) is not None and not rows:
+            del self._channels[user_id]
+        self._apply_auto(user_id, chat_id, 0)
+
+    def _apply_auto(self, user_id, chat_id, value):
+        row = self._channels.get(user_id, {}).get(chat_id)
+        if row is not None:
+            row['auto_accept'] = value
+        owners = self._auto_accept.get(chat_id)
+        if value and row is not None:
+            self._auto_accept.setdefault(chat_id, set()).add(user_id)
+        elif owners is not None:
+            owners.discard(user_id)
+            if not owners:
+                del self._auto_accept[chat_id]
+
+    def _apply_pending(self, rows, created_at):
+        for chat_id, user_id, first_name, username in rows:
+            requests = self._pending.get(chat_id)
+            if requests is None:
+                requests = self._pending[chat_id] = OrderedDict()
+            requests.pop(user_id, None)
+            requests[user_id] = (self._next_pending_id, first_name, username, created_at)
+            self._next_pending_id += 1
+
+    def _apply_unpending(self, keys):
+        for chat_id, user_id in keys:
+            requests = self._pending.get(chat_id)
+            if requests is not None and requests.pop(user_id, None) is not None and not requests:
+                del self._pending[chat_id]
+
+    # Users
+
+    def add_user(self, user_id, username, first_name):
+        user = self._users.get(user_id)
+        if user is not None and user[:2] == (username, first_name):
+            return
+        created_at = user[2] if user is not None else _timestamp()
+        self._write('user', user_id, username, first_name, created_at)
+
+    # Channels
+
+    def _channel_row(self, row):
+        return dict(row, pending_count=len(self._pending.get(row['chat_id'], ())))
+
+    def add_channel(self, user_id, chat_id, title, chat_type):
+        if chat_id in self._channels.get(user_id, {}):
+            return False
+        self._write('channel', self._next_channel_id, user_id, chat_id, title, chat_type, _timestamp())
+        return True
+
+    def get_user_channels(self, user_id, limit=-1, offset=0):
+        rows = self._channels.get(user_id, {}).values()
+        stop = None if limit is None or limit < 0 else offset + limit
+        return [self._channel_row(row) for row in islice(rows, offset, stop)]
+
+    def get_channel(self, user_id, chat_id):
+        row = self._channels.get(user_id, {}).get(chat_id)
+        return self._channel_row(row) if row is not None else None
+
+    def delete_channel(self, user_id, chat_id):
+        if chat_id not in self._channels.get(user_id, {}):
+            return
+        self._write('unchannel', user_id, chat_id)
+
+    def toggle_auto_accept(self, user_id, chat_id):
+        row = self._channels.get(user_id, {}).get(chat_id)
+        if row is None:
+            return 0
+        value = 0 if row['auto_accept'] else 1
+        self._write('auto', user_id, chat_id, value)
+        return value
+
+    def get_auto_accept_channels(self):
+        return [dict(self._channels[user_id][chat_id])
+                for chat_id, owners in self._auto_accept.items() for user_id in owners]
+
+    def is_auto_accept(self, chat_id):
+        return chat_id in self._auto_accept
+
+    def refresh_auto_accept_index(self):
+        # Only this process sees the data
+        return False
+
+    # Pending requests
+
+    def _pending_row(self, chat_id, user_id, row):
+        pending_id, first_name, username, created_at = row
+        return {'id': pending_id, 'chat_id': chat_id, 'user_id': user_id,
+                'first_name': first_name, 'username': username, 'created_at': created_at}
+
+    def add_pending_request(self, chat_id, user_id, first_name, username):
+        return self.add_pending_requests([(chat_id, user_id, first_name, username)])
+
+    def add_pending_requests(self, rows):
+        rows = [list(row) for row in rows]
+        if rows:
+            self._write('pending', rows, _timestamp())
+        return True
+
+    def get_pending_requests(self, chat_id, limit=None):
+        requests = self._pending.get(chat_id, {})
+        return [self._pending_row(chat_id, user_id, row)
+                for user_id, row in islice(requests.items(), limit or None)]
+
+    def get_pending_page(self, chat_id, limit, after=None):
+        items = self._pending.get(chat_id, {}).items()
+        if after is not None:
+            # Rows are kept in id order; drained pages are deleted, so little is skipped
+            items = dropwhile(lambda item: item[1][0] <= after[1], items)
+        return [self._pending_row(chat_id, user_id, row) for user_id, row in islice(items, limit)]
+
+    def delete_pending_request(self, chat_id, user_id):
+        self.delete_pending_requests(chat_id, [user_id])
+
+    def delete_pending_requests(self, chat_id, user_ids):
+        requests = self._pending.get(chat_id, {})
+        keys = [[chat_id, user_id] for user_id in user_ids if user_id in requests]
+        if keys:
+            self._write('unpending', keys)
+
+    def get_pending_count(self, chat_id):
+        return len(self._pending.get(chat_id, ()))
+
+    def expire_pending_requests(self, max_age_seconds, limit):
+        cutoff = _timestamp(time.time() - max_age_seconds)
+        keys = []
+        for chat_id, requests in self._pending.items():
+            for user_id, row in requests.items():
+                if row[3] >= cutoff or len(keys) >= limit:
+                    break
+                keys.append([chat_id, user_id])
+            if len(keys) >= limit:
+                break
+        if keys:
+            self._write('unpending', keys)
+        return len(keys)
@@ -0,0 +1,224 @@
+"""
+Lightweight in-process metrics with an optional Prometheus endpoint.
+
+Handlers, database.py queries (timed on the DB thread by async_db) and Bot
+API calls (counted by ratelimit.RateGovernor) record into the module-level
+registry. Recording is a dict lookup plus a bisect under a per-metric lock
+(the DB thread records too, while the event loop may be rendering), so it
+stays on in production; METRICS_ENABLED only controls the local HTTP
+endpoint that serves the registry in Prometheus text format on /metrics.
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Gauge:
+    """Value sampled from a callback when the metrics are rendered"""
+
+    type = "gauge"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._function = None
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            yield f"{self.name} {self._function()}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by labels"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            # Copies, so the counts of a series are consistent with each other
+            snapshot = [(label_values, list(series)) for label_values, series in self._series.items()]
+        for label_values, series in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            cumulative += series[len(self.buckets)]
+            labels = _format_labels(self.labels, label_values, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {series[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.register(Histogram(
+    "bot_handler_seconds", "Time spent in update handlers", ["handler", "action"]))
+HANDLER_ERRORS = registry.register(Counter(
+    "bot_handler_errors_total", "Exceptions raised by update handlers", ["handler", "error"]))
+DB_SECONDS = registry.register(Histogram(
+    "bot_db_query_seconds", "Time spent in database.py functions on the DB thread", ["function"]))
+API_CALLS = registry.register(Counter(
+    "bot_api_calls_total", "Bot API calls made", ["endpoint"]))
+API_ERRORS = registry.register(Counter(
+    "bot_api_errors_total", "Bot API calls that raised, by error type", ["endpoint", "error"]))
+UPDATE_QUEUE_DEPTH = registry.register(Gauge(
+    "bot_update_queue_depth", "Updates received but not yet processed"))
+PENDING_BUFFER_DEPTH = registry.register(Gauge(
+    "bot_pending_buffer_depth", "Join requests waiting in the write-behind buffer"))
+CACHE_LOOKUPS = registry.register(Counter(
+    "bot_cache_lookups_total", "Cached Telegram lookups by cache and hit/miss", ["cache", "result"]))
+APPROVAL_RETRIES = registry.register(Counter(
+    "bot_approval_retries_total", "Retry queue events: deferred, accepted, rescheduled, failed, exhausted",
+    ["outcome"]))
+SCHEDULER_JOBS = registry.register(Gauge(
+    "bot_scheduler_jobs", "Approval jobs registered with the fair scheduler"))
+SCHEDULER_WAITING = registry.register(Gauge(
+    "bot_scheduler_waiting_jobs", "Approval jobs waiting for their turn"))
+PENDING_EXPIRED = registry.register(Counter(
+    "bot_pending_expired_total", "Pending join requests dropped for exceeding PENDING_TTL_DAYS"))
+DB_PAGES_FREED = registry.register(Counter(
+    "bot_db_pages_freed_total", "Database pages returned to the filesystem by incremental vacuum"))
+
+
+def timed_handler(name, action=None):
+    """Decorator recording latency and exceptions of an async update handler
+
+    action: optional function(update, context) -> label splitting the handler by
+    branch, called after the handler so it can read what the handler recorded
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception as e:
+                HANDLER_ERRORS.inc(name, type(e).__name__)
+                raise
+            finally:
+                label = action(update, context) if action is not None else ""
+                HANDLER_SECONDS.observe(time.perf_counter() - started, name, label)
+        return wrapper
+    return decorator
+
+
+def timed_call(name, func, *args, **kwargs):
+    """Call a (blocking) function and record its duration in DB_SECONDS"""
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - started, name)
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host, port):
+    """Serve /metrics on host:port; returns the asyncio server (close() to stop)"""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("Metrics endpoint listening on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,93 @@
+"""
+On-demand profiler for the running bot.
+
+An admin sends /profile N and the bot runs cProfile for N seconds on the
+event-loop thread (handlers, approval jobs, API calls) and on the DB thread
+(database.py queries), then merges both profiles. On Python 3.12+ cProfile
+is built on sys.monitoring, which allows one profiler per interpreter and
+sees every thread, so a single profile covers both. The report lists the
+functions with the most own time and comes with a .prof dump that loads in
+pstats, snakeviz and similar tools.
+"""
+
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import time
+
+import async_db
+
+# Blocking waits of idle threads: the event loop's selector and the DB worker's
+# queue. They would otherwise top every report without being work.
+IDLE_FUNCTIONS = ("of 'select.", "of '_queue.SimpleQueue'")
+
+# cProfile on sys.monitoring: one active profiler, covering all threads
+SINGLE_PROFILER = sys.version_info >= (3, 12)
+
+
+class ProfileResult:
+    """Merged profile of one window"""
+
+    def __init__(self, stats, seconds):
+        self.stats = stats
+        self.seconds = seconds
+
+    def top(self, limit):
+        """Text table of the `limit` busiest functions by own time, idle waits excluded"""
+        rows = [item for item in self.stats.stats.items()
+                if not any(idle in item[0][2] for idle in IDLE_FUNCTIONS)]
+        rows = sorted(rows, key=lambda item: -item[1][2])[:limit]
+        lines = [f"{'own s':>8} {'cum s':>8} {'calls':>8}  function"]
+        for (filename, line, name), (_, calls, own, cumulative, _) in rows:
+            location = f"{os.path.basename(filename)}:{line}" if filename != "~" else ""
+            lines.append(f"{own:>8.3f} {cumulative:>8.3f} {calls:>8}  {location}({name})")
+        return "\n".join(lines)
+
+    def dump(self):
+        """The profile in pstats' dump_stats format"""
+        return io.BytesIO(marshal.dumps(self.stats.stats))
+
+
+class Profiler:
+    """Runs one profiling window at a time"""
+
+    def __init__(self):
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    async def profile(self, seconds):
+        """Profile the event loop and DB threads for `seconds`; None if already running"""
+        if self._running:
+            return None
+        self._running = True
+        loop_profile = cProfile.Profile()
+        db_profile = None if SINGLE_PROFILER else cProfile.Profile()
+        started = time.monotonic()
+        try:
+            if db_profile is not None:
+                await async_db.call(db_profile.enable)
+            loop_profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                loop_profile.disable()
+                if db_profile is not None:
+                    await async_db.call(db_profile.disable)
+        finally:
+            self._running = False
+
+        stats = pstats.Stats(loop_profile)
+        # A profile that saw no calls has no stats to add
+        if db_profile is not None and db_profile.getstats():
+            stats.add(db_profile)
+        return ProfileResult(stats, time.monotonic() - started)
+
+
+profiler = Profiler()
@@ -0,0 +1,261 @@
+"""
+Rate limiting for Telegram Bot API calls.
+
+RateGovernor is installed as the Application's rate limiter, so every API
+call made through the bot (handlers, approval jobs, progress edits) passes
+through one global token bucket plus a per-chat bucket for endpoints that
+post into a chat. Waiting calls are served by priority class, so interactive
+UI work goes ahead of bulk approvals, and a RetryAfter pauses calls for the
+requested time before the call is retried: only calls into that chat when it
+came from an endpoint that posts into a chat (Telegram's per-chat flood
+limit), all calls otherwise. Callers that have somewhere better to put the
+call than a sleeping handler pass rate_limit_args=FAIL_FAST: the RetryAfter
+(or an ongoing pause) is raised to them at once instead of being waited out.
+"""
+
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+import metrics
+from config import (
+    RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL_BURST, RATE_LIMIT_PRIVATE_CHAT,
+    RATE_LIMIT_GROUP_CHAT, RATE_LIMIT_CHAT_BURST, RATE_LIMIT_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Priority classes: lower values are served first
+PRIORITY_INTERACTIVE = 0   # callback answers, menu edits, replies to a user action
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2          # join request approvals
+
+ENDPOINT_PRIORITIES = {
+    "answerCallbackQuery": PRIORITY_INTERACTIVE,
+    "editMessageText": PRIORITY_INTERACTIVE,
+    "sendMessage": PRIORITY_INTERACTIVE,
+    "getChatMember": PRIORITY_INTERACTIVE,
+    "getChat": PRIORITY_INTERACTIVE,
+    "approveChatJoinRequest": PRIORITY_BULK,
+    "declineChatJoinRequest": PRIORITY_BULK,
+}
+
+# Endpoints that post into a chat and count against Telegram's per-chat limits
+CHAT_ENDPOINTS = {"sendMessage", "editMessageText", "sendDocument", "sendPhoto"}
+
+# Endpoints that are not rate limited by Telegram
+UNLIMITED_ENDPOINTS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo"}
+
+# Idle per-chat buckets kept before the least recently used are dropped
+MAX_CHAT_BUCKETS = 10000
+
+# rate_limit_args for calls that must not wait out a flood wait (e.g. in an update handler)
+FAIL_FAST = {"fail_fast": True}
+
+
+def retry_after_seconds(error):
+    """Seconds to wait for a RetryAfter (int or timedelta depending on PTB version)"""
+    value = error.retry_after
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def is_transient(error):
+    """Flood waits, network errors and timeouts are worth retrying; BadRequest and Forbidden are not"""
+    if isinstance(error, RetryAfter):
+        return True
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+class TokenBucket:
+    """Async token bucket: refills `rate` tokens per second up to `capacity`
+
+    Waiters are served in priority order (lower first), FIFO within a priority.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters = []             # heap of (priority, seq, tokens, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, tokens):
+        """Take `tokens` if available (returns 0), else return the seconds until they are"""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens=1, priority=PRIORITY_DEFAULT):
+        """Wait until `tokens` are available and take them"""
+        if not self._waiters and not self._take(tokens):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():  # cancelled waiter
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._take(tokens)
+            if not wait:
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+                continue
+            await asyncio.sleep(wait)
+
+
+def shared_bucket_state(context, capacity):
+    """Shared memory for a SharedTokenBucket, starting full; pass it to each process"""
+    return context.Array('d', [capacity, time.monotonic()])
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose tokens live in shared memory, so processes draw on one budget
+
+    state: from shared_bucket_state(); every process builds its own bucket on
+    it with the same rate and capacity. Priorities apply within a process.
+    """
+
+    def __init__(self, rate, capacity, state):
+        super().__init__(rate, capacity)
+        self._state = state
+
+    def _take(self, tokens):
+        # The monotonic clock is system wide, so every process refills alike
+        with self._state.get_lock():
+            available, updated = self._state
+            now = time.monotonic()
+            available = min(self.capacity, available + (now - updated) * self.rate)
+            taken = tokens if available >= tokens else 0
+            self._state[0] = available - taken
+            self._state[1] = now
+        return 0 if taken else (tokens - available) / self.rate
+
+
+class RateGovernor(BaseRateLimiter):
+    """Global + per-chat throttling with priorities and RetryAfter backoff"""
+
+    def __init__(self, global_rate=RATE_LIMIT_GLOBAL, global_burst=RATE_LIMIT_GLOBAL_BURST,
+                 private_chat_rate=RATE_LIMIT_PRIVATE_CHAT, group_chat_rate=RATE_LIMIT_GROUP_CHAT,
+                 chat_burst=RATE_LIMIT_CHAT_BURST, max_retries=RATE_LIMIT_MAX_RETRIES,
+                 global_bucket=None):
+        # global_bucket: e.g. a SharedTokenBucket, instead of one built from global_rate/burst
+        self.global_bucket = global_bucket or TokenBucket(global_rate, global_burst)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = OrderedDict()
+        self._paused_until = 0.0
+        self._chat_paused_until = {}   # chat_id -> monotonic time its flood wait ends
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            rate = self.private_chat_rate if is_private else self.group_chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _paused_for(self, chat_id=None):
+        """Seconds left before calls (into chat_id) may be made again"""
+        paused_until = self._paused_until
+        if chat_id is not None and chat_id in self._chat_paused_until:
+            paused_until = max(paused_until, self._chat_paused_until[chat_id])
+        return paused_until - time.monotonic()
+
+    async def _wait_if_paused(self, chat_id=None):
+        while (remaining := self._paused_for(chat_id)) > 0:
+            await asyncio.sleep(remaining)
+        if chat_id is not None and chat_id in self._chat_paused_until:
+            del self._chat_paused_until[chat_id]
+
+    def _pause(self, chat_id, seconds):
+        """Pause one chat (chat_id not None) or every call for `seconds`"""
+        until = time.monotonic() + seconds
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, until)
+        else:
+            self._chat_paused_until[chat_id] = max(self._chat_paused_until.get(chat_id, 0.0), until)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        metrics.API_CALLS.inc(endpoint)
+        try:
+            return await self._process_request(callback, args, kwargs, endpoint, data,
+                                               rate_limit_args)
+        except TelegramError as e:
+            metrics.API_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+
+    async def _process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_DEFAULT)
+        fail_fast = False
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get("priority", priority)
+            fail_fast = rate_limit_args.get("fail_fast", False)
+        chat_id = data.get("chat_id") if endpoint in CHAT_ENDPOINTS else None
+        max_retries = 0 if fail_fast else self.max_retries
+
+        attempt = 0
+        while True:
+            if fail_fast and (remaining := self._paused_for(chat_id)) > 0:
+                raise RetryAfter(math.ceil(remaining))
+            await self._wait_if_paused(chat_id)
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire(priority=priority)
+            await self.global_bucket.acquire(priority=priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    if fail_fast:
+                        # Other calls still back off, as if it had been waited out here
+                        self._pause(chat_id, retry_after_seconds(e))
+                    raise
+                metrics.API_ERRORS.inc(endpoint, "RetryAfter")
+                attempt += 1
+                seconds = retry_after_seconds(e)
+                self._pause(chat_id, seconds)
+                if chat_id is None:
+                    logger.warning("Flood control on %s, pausing all API calls for %.1fs",
+                                   endpoint, seconds)
+                else:
+                    logger.warning("Flood control on %s in chat %s, pausing that chat for %.1fs",
+                                   endpoint, chat_id, seconds)
@@ -0,0 +1,79 @@
+"""
+Recording of incoming updates for replay.py.
+
+When RECORD_UPDATES_PATH is set, every update is appended to that file as a
+gzip-compressed JSON line {"t": <unix time received>, "update": <update as
+sent by Telegram>}, as it leaves the update queue and before it waits for a
+worker (update_processor.KeyedUpdateProcessor), so bursts keep their real
+timing; in sharded mode the ingress process records instead. While updates
+arrive the gzip stream is flushed every RECORD_FLUSH_INTERVAL seconds, and
+on shutdown; restarts append new gzip members to the same file.
+"""
+
+import gzip
+import json
+import logging
+import time
+
+from config import RECORD_UPDATES_PATH, RECORD_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateRecorder:
+    """Appends updates with their arrival time to a .jsonl.gz file"""
+
+    def __init__(self, path=RECORD_UPDATES_PATH, flush_interval=RECORD_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._file = None
+        self._last_flush = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def write(self, update, received_at=None):
+        if self._file is None:
+            self._file = gzip.open(self.path, 'ab')
+            self._last_flush = time.monotonic()
+            logger.info("Recording updates to %s", self.path)
+        line = {"t": time.time() if received_at is None else received_at, "update": update.to_dict()}
+        self._file.write(json.dumps(line, ensure_ascii=False, separators=(',', ':')).encode() + b'\n')
+        self.recorded += 1
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+            self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_recording(path):
+    """Yield (received_at, update dict) from a recording (gzip or plain JSON lines)
+
+    A recording cut short by a crash is read up to the last complete line.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping unreadable line in %s", path)
+                    continue
+                yield entry["t"], entry["update"]
+        except EOFError:
+            logger.warning("%s ends in an incomplete gzip member, stopping there", path)
+
+
+# Shared recorder (disabled unless RECORD_UPDATES_PATH is set)
+recorder = UpdateRecorder()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Replay recorded updates (recorder.py) through the bot.
+
+Feeds a recording into the real Application (handlers, update processor,
+DB writer) backed by harness.FakeBotAPI and a scratch database, keeping the
+recorded gaps between updates scaled by --speed (1 = as recorded, 10 = ten
+times faster, 0 = as fast as possible). Reports throughput, the latency from
+delivery to the end of handling, the API calls made and how much the
+database grew. Start from a copy of a real database with --db so owners,
+channels and auto accept settings match the recording. The API rate
+governor and the approval token bucket are off unless --rate-limit is given.
+
+    python replay.py updates.jsonl.gz                           # real time
+    python replay.py updates.jsonl.gz --speed 20
+    python replay.py updates.jsonl.gz --speed 0 --db bot_data.db --latency 0.05
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from itertools import islice
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import approvals
+import bot
+import database
+import harness
+from ingest import pending_writer
+from recorder import read_recording
+
+# Handler group of the timing handler: after every other handler
+DONE_GROUP = 1000
+
+# Tables whose growth is reported
+TABLES = ["users", "channels", "pending_requests", "approval_retries", "approval_jobs"]
+
+
+def copy_database(path):
+    """Consistent copy of a (possibly live) database into a scratch directory"""
+    target = os.path.join(tempfile.mkdtemp(prefix="bot_replay_"), "bot_data.db")
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    with sqlite3.connect(target) as copy:
+        source.backup(copy)
+    source.close()
+    return target
+
+
+def database_size():
+    """Bytes in use by the database (pages, whether in the main file or still in the WAL)"""
+    conn = database.get_connection()
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return (page_count - freelist) * conn.execute("PRAGMA page_size").fetchone()[0]
+
+
+def row_counts():
+    conn = database.get_connection()
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in TABLES}
+
+
+def update_kind(data):
+    return next((key for key in data if key != "update_id"), "unknown")
+
+
+async def run(path, speed, limit, db, latency, rate_limit):
+    entries = list(islice(read_recording(path), limit))
+    if not entries:
+        print(f"no updates in {path}")
+        return
+
+    db_path = harness.use_scratch_db(copy_database(db) if db else None)
+    size_before = database_size()
+    rows_before = row_counts()
+
+    api = harness.FakeBotAPI(latency=latency, seed=1)
+    application, _ = harness.make_application(api, rate_limiter=None if rate_limit else False)
+    delivered_at = {}    # id(update) -> perf_counter when queued
+    latencies = []
+    errors = Counter()
+    kinds = Counter()
+    all_queued = False
+    finished = asyncio.Event()
+
+    async def on_done(update, context):
+        latencies.append(time.perf_counter() - delivered_at.pop(id(update)))
+        if all_queued and not delivered_at:
+            finished.set()
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_handler(TypeHandler(Update, on_done), group=DONE_GROUP)
+    application.add_error_handler(on_error)
+
+    await application.initialize()
+    await bot.post_init(application)
+    if not rate_limit:
+        approvals.configure_engine(application.bot, rate=float("inf"), burst=float("inf"))
+    await application.start()
+
+    loop = asyncio.get_running_loop()
+    first = entries[0][0]
+    started = loop.time()
+    started_perf = time.perf_counter()
+    for received_at, data in entries:
+        if speed:
+            delay = started + (received_at - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(data, application.bot)
+        kinds[update_kind(data)] += 1
+        delivered_at[id(update)] = time.perf_counter()
+        await application.update_queue.put(update)
+    all_queued = True
+    if delivered_at:
+        try:
+            await asyncio.wait_for(finished.wait(), timeout=max(60, len(entries) / 100))
+        except asyncio.TimeoutError:
+            print(f"timed out: {len(latencies)}/{len(entries)} updates handled")
+    await pending_writer.flush()
+    elapsed = time.perf_counter() - started_perf
+
+    await application.stop()
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+    size_after = database_size()
+    rows_after = row_counts()
+    database.close_connection()
+
+    span = entries[-1][0] - first
+    print(f"recording:   {path} ({span:.1f}s of traffic)")
+    print(f"updates:     {len(entries)} ({', '.join(f'{kind} {n}' for kind, n in kinds.most_common())})")
+    print(f"speed:       {f'{speed:g}x' if speed else 'max'}")
+    print(f"elapsed:     {elapsed:.2f}s")
+    print(f"throughput:  {len(latencies) / elapsed:.0f} updates/s")
+    for q in (50, 90, 99):
+        print(f"p{q} latency: {harness.percentile(latencies, q) * 1000:.1f} ms")
+    print(f"max latency: {max(latencies, default=0) * 1000:.1f} ms")
+    print(f"API calls:   {dict(api.calls)}")
+    if errors:
+        print(f"handler errors: {dict(errors)}")
+    print(f"database:    {size_before / 1e6:.2f} MB -> {size_after / 1e6:.2f} MB "
+          f"({(size_after - size_before) / 1e6:+.2f} MB) [{db_path}]")
+    for table in TABLES:
+        print(f"  {table:<18}{rows_before[table]:>10} -> {rows_after[table]:<10}"
+              f"({rows_after[table] - rows_before[table]:+d})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", help="file written by the recorder (.jsonl.gz or .jsonl)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed: 1 = as recorded, N = N times faster, 0 = max")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--db", help="start from a copy of this database instead of an empty one")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API latency (s)")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the rate governor and approval token bucket on")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must be 0 or more")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args.recording, args.speed, args.limit, args.db, args.latency,
+                    args.rate_limit))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Durable retry queue for join request approvals.
+
+An approval that fails with a transient error (flood wait, network error,
+timeout) is deferred into the approval_retries table instead of being
+dropped or parked in pending_requests. A background worker approves due
+retries in batches through the shared approval engine (same rate limit as
+approval jobs); each further transient failure is rescheduled with
+exponential backoff and jitter. Permanent errors end the retry, and a
+request that is still failing after RETRY_MAX_ATTEMPTS is moved to
+pending_requests so the owner can accept it manually.
+
+Deferred requests go through their own write-behind buffer (an
+ingest.PendingWriter writing to approval_retries): one transaction every
+RETRY_FLUSH_ROWS rows or RETRY_FLUSH_INTERVAL seconds, so a flood of
+failures does not turn into one commit per join request, and the writes do
+not wait for the retry worker, which can sit in flood waits for minutes.
+The buffer holds at most RETRY_BUFFER_SIZE rows before defer() waits, and
+approval jobs flush it before removing the requests from pending_requests.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from itertools import groupby
+
+from telegram.error import RetryAfter
+
+import async_db as db
+import metrics
+from config import (
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_ATTEMPTS, RETRY_BATCH_SIZE, RETRY_POLL_INTERVAL,
+    RETRY_BUFFER_SIZE, RETRY_FLUSH_ROWS, RETRY_FLUSH_INTERVAL
+)
+from ingest import PendingWriter
+from ratelimit import is_transient, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts, error=None, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Seconds before the next attempt: exponential backoff with jitter
+
+    Never shorter than the wait a RetryAfter asked for.
+    """
+    delay = min(cap, base * 2 ** attempts)
+    delay = random.uniform(delay / 2, delay)
+    if isinstance(error, RetryAfter):
+        delay = max(delay, retry_after_seconds(error))
+    return delay
+
+
+class DeferralWriter(PendingWriter):
+    """Buffered, batched writer for deferred approvals (approval_retries rows)"""
+
+    rows_name = "deferred approvals"
+    task_name = "retry_writer"
+
+    def __init__(self, max_buffer=RETRY_BUFFER_SIZE, flush_rows=RETRY_FLUSH_ROWS,
+                 flush_interval=RETRY_FLUSH_INTERVAL):
+        super().__init__(max_buffer, flush_rows, flush_interval)
+
+    async def _store(self, rows):
+        await db.schedule_approval_retries(rows)
+        return True
+
+
+class RetryQueue:
+    """Schedules failed approvals and retries them in the background"""
+
+    def __init__(self, batch_size=RETRY_BATCH_SIZE, interval=RETRY_POLL_INTERVAL,
+                 max_attempts=RETRY_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.writer = DeferralWriter()
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    @property
+    def buffered(self):
+        """Deferred approvals not yet written to the database"""
+        return self.writer.buffered
+
+    async def defer(self, chat_id, user_id, first_name, username, error, attempts=0):
+        """Schedule an approval that failed with a transient error"""
+        row = (chat_id, user_id, first_name, username, attempts + 1,
+               time.time() + retry_delay(attempts, error), type(error).__name__)
+        metrics.APPROVAL_RETRIES.inc("deferred")
+        await self.writer.put(row)
+
+    def start_writer(self):
+        """Buffer deferrals without running the retry worker (sharded workers other than 0)"""
+        self.writer.start()
+
+    def start(self, get_engine):
+        """Start the writer and the worker; get_engine() returns the ApprovalEngine to approve with"""
+        self.writer.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(get_engine), name="approval_retries")
+
+    async def stop(self):
+        """Stop the worker and write everything still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.writer.stop()
+
+    async def flush(self):
+        """Wait until every deferral so far is written; False if some could not be"""
+        return await self.writer.flush()
+
+    async def run_once(self, engine):
+        """Flush deferrals and approve one batch of due retries; returns the number tried"""
+        await self.flush()
+        due = await db.get_due_approval_retries(time.time(), self.batch_size)
+        due.sort(key=lambda row: row['chat_id'])
+        for chat_id, rows in groupby(due, key=lambda row: row['chat_id']):
+            await self._retry_chat(engine, chat_id, list(rows))
+        return len(due)
+
+    async def _retry_chat(self, engine, chat_id, rows):
+        failures = {}
+        await engine.approve_many(chat_id, [row['user_id'] for row in rows], failures)
+
+        done, again, give_up = [], [], []
+        for row in rows:
+            error = failures.get(row['user_id'])
+            if error is None:
+                metrics.APPROVAL_RETRIES.inc("accepted")
+                done.append((chat_id, row['user_id']))
+            elif not is_transient(error):
+                metrics.APPROVAL_RETRIES.inc("failed")
+                done.append((chat_id, row['user_id']))
+            elif row['attempts'] >= self.max_attempts:
+                metrics.APPROVAL_RETRIES.inc("exhausted")
+                give_up.append((chat_id, row['user_id'], row['first_name'], row['username']))
+            else:
+                metrics.APPROVAL_RETRIES.inc("rescheduled")
+                again.append((chat_id, row['user_id'], row['first_name'], row['username'],
+                              row['attempts'] + 1,
+                              time.time() + retry_delay(row['attempts'], error),
+                              type(error).__name__))
+        if done:
+            await db.delete_approval_retries(done)
+        if again:
+            await db.schedule_approval_retries(again)
+        if give_up:
+            logger.warning("Giving up on %d approvals in %s after %d attempts, kept as pending",
+                           len(give_up), chat_id, self.max_attempts)
+            if not await db.move_approval_retries_to_pending(give_up):
+                # Still due, so the next pass tries them (and the move) again
+                logger.error("Could not move %d given-up approvals in %s to pending, keeping them queued",
+                             len(give_up), chat_id)
+
+    async def _loop(self, get_engine):
+        while True:
+            try:
+                tried = await self.run_once(get_engine())
+            except Exception:
+                logger.exception("Approval retry round failed")
+                tried = 0
+            # A full batch means more may be due already
+            if tried < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+
+# Shared retry queue used by the handlers and approval jobs
+retry_queue = RetryQueue()
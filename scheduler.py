@@ -0,0 +1,173 @@
+"""
+Fair sharing of the approval rate between approval jobs.
+
+Before each slice of approvals a job asks the scheduler for a turn. Turns
+are handed out by deficit round robin over owners: every visit credits an
+owner SCHEDULER_QUANTUM approvals times its weight (SCHEDULER_OWNER_WEIGHTS,
+1 by default), and the credit is spent on that owner's waiting jobs in
+turn. Only SCHEDULER_SLOTS slices run at once, so an owner draining a 100k
+backlog gets the same share as an owner who wants 10 approvals, and the
+small job is done after a few turns instead of after the big one. Owners
+can run at most SCHEDULER_MAX_JOBS_PER_OWNER jobs at once.
+
+status() gives a job's place in line and an estimate of the time it needs,
+assuming the approval rate is split by weight between owners with jobs.
+"""
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+from config import (
+    APPROVAL_RATE, SCHEDULER_QUANTUM, SCHEDULER_SLOTS, SCHEDULER_MAX_JOBS_PER_OWNER,
+    SCHEDULER_OWNER_WEIGHTS
+)
+
+
+class _Owner:
+    __slots__ = ("weight", "deficit", "jobs", "waiting")
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.deficit = 0.0
+        self.jobs = set()        # registered job_ids
+        self.waiting = deque()   # job_ids waiting for a turn, in arrival order
+
+
+class FairScheduler:
+    """Deficit round robin of approval slices across job owners"""
+
+    def __init__(self, rate=APPROVAL_RATE, quantum=SCHEDULER_QUANTUM, slots=SCHEDULER_SLOTS,
+                 max_jobs_per_owner=SCHEDULER_MAX_JOBS_PER_OWNER, weights=SCHEDULER_OWNER_WEIGHTS):
+        self.rate = rate
+        self.quantum = quantum
+        self.slots = slots
+        self.max_jobs_per_owner = max_jobs_per_owner
+        self.weights = weights
+        self._owners = {}      # owner_id -> _Owner, for owners with registered jobs
+        self._ring = deque()   # owner_ids in round robin order
+        self._jobs = {}        # job_id -> owner_id
+        self._remaining = {}   # job_id -> approvals still to do
+        self._requests = {}    # job_id -> (wanted, future) while waiting for a turn
+        self._running = set()  # job_ids holding a slot
+
+    @property
+    def active_jobs(self):
+        return len(self._jobs)
+
+    @property
+    def waiting_jobs(self):
+        return len(self._requests)
+
+    def at_quota(self, owner_id):
+        """True if the owner may not start another job now"""
+        owner = self._owners.get(owner_id)
+        return owner is not None and len(owner.jobs) >= self.max_jobs_per_owner
+
+    def register(self, job_id, owner_id, remaining):
+        owner = self._owners.get(owner_id)
+        if owner is None:
+            owner = self._owners[owner_id] = _Owner(self.weights.get(owner_id, 1))
+            self._ring.append(owner_id)
+        owner.jobs.add(job_id)
+        self._jobs[job_id] = owner_id
+        self._remaining[job_id] = remaining
+
+    def unregister(self, job_id):
+        owner_id = self._jobs.pop(job_id, None)
+        if owner_id is None:
+            return
+        self._remaining.pop(job_id, None)
+        self._drop_request(job_id)
+        self._running.discard(job_id)
+        owner = self._owners[owner_id]
+        owner.jobs.discard(job_id)
+        if not owner.jobs:
+            del self._owners[owner_id]
+            self._ring.remove(owner_id)
+        self._dispatch()
+
+    def set_remaining(self, job_id, remaining):
+        if job_id in self._remaining:
+            self._remaining[job_id] = remaining
+
+    @asynccontextmanager
+    async def turn(self, job_id, wanted):
+        """Wait for a slot; yields how many of the `wanted` approvals the job may do now"""
+        granted = await self._acquire(job_id, wanted)
+        try:
+            yield granted
+        finally:
+            self._running.discard(job_id)
+            self._dispatch()
+
+    async def _acquire(self, job_id, wanted):
+        future = asyncio.get_running_loop().create_future()
+        self._requests[job_id] = (wanted, future)
+        self._owners[self._jobs[job_id]].waiting.append(job_id)
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the job was cancelled: hand the slot on
+                self._running.discard(job_id)
+            self._drop_request(job_id)
+            self._dispatch()
+            raise
+
+    def _drop_request(self, job_id):
+        if self._requests.pop(job_id, None) is not None:
+            owner = self._owners.get(self._jobs.get(job_id))
+            if owner is not None and job_id in owner.waiting:
+                owner.waiting.remove(job_id)
+
+    def _dispatch(self):
+        while self._requests and len(self._running) < self.slots:
+            owner = self._owners[self._ring[0]]
+            if not owner.waiting:
+                # Credit is not saved up while an owner has nothing waiting
+                owner.deficit = 0.0
+                self._ring.rotate(-1)
+                continue
+            job_id = owner.waiting.popleft()
+            wanted, future = self._requests.pop(job_id)
+            if future.done():
+                # Cancelled while waiting; its _acquire has not cleaned up yet
+                continue
+            if owner.deficit <= 0:
+                owner.deficit += self.quantum * owner.weight
+            granted = min(wanted, max(1, int(owner.deficit)))
+            owner.deficit -= granted
+            future.set_result(granted)
+            self._running.add(job_id)
+            if owner.deficit <= 0 or not owner.waiting:
+                if not owner.waiting:
+                    owner.deficit = 0.0
+                self._ring.rotate(-1)
+
+    def status(self, job_id):
+        """(place in line, estimated seconds left) of a job
+
+        The place is 0 while the job is approving or between turns, and None
+        values are returned for unknown jobs.
+        """
+        owner_id = self._jobs.get(job_id)
+        if owner_id is None:
+            return None, None
+        position = 0
+        if job_id in self._requests:
+            for ring_owner in self._ring:
+                waiting = self._owners[ring_owner].waiting
+                if job_id in waiting:
+                    position += waiting.index(job_id) + 1
+                    break
+                position += len(waiting)
+        owner = self._owners[owner_id]
+        total_weight = sum(o.weight for o in self._owners.values())
+        job_rate = self.rate * owner.weight / total_weight / len(owner.jobs)
+        return position, self._remaining[job_id] / job_rate
+
+
+# Shared scheduler used by approval jobs
+scheduler = FairScheduler()
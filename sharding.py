@@ -0,0 +1,264 @@
+"""
+Multi-process mode: one ingress process fans updates out to worker processes.
+
+A single Application runs on one core. With SHARD_WORKERS > 1, bot.main
+starts an ingress process that only receives updates (polling or webhook)
+and passes each one, as its JSON dict, to worker shard_of(chat_id) over a
+multiprocessing queue. Every worker is a normal Application with all the
+handlers, its own DB thread, pending writer and approval engine, so the
+Python work per update scales with cores. Updates of one chat always go to
+the same worker, in order; private chats have the user's id, so a user's
+menus and states stay on one worker too.
+
+Workers share the SQLite database file (WAL, busy_timeout), so this mode
+needs STORAGE_BACKEND = "sqlite". Each worker keeps its own auto accept
+index and reloads it when another worker has written
+(database.refresh_auto_accept_index). The API budgets (RATE_LIMIT_GLOBAL,
+APPROVAL_RATE) are token buckets in shared memory (ratelimit.SharedTokenBucket),
+so a busy worker can use what idle workers leave. Approval jobs run in worker
+0 only: the ingress sends every accept and cancel button there, whichever
+chat it comes from, so the fair scheduler, the per-owner job limit and the
+one-job-per-chat guard see all jobs. Those buttons can therefore overtake an
+owner's other clicks, which stay on the owner's worker. A chat's join
+requests are still buffered by the worker that owns the chat, so before a
+job reads the backlog, worker 0 asks that worker to flush its pending writer
+(PendingFlushes) and waits for it. Maintenance and the retry queue also run
+in worker 0, and worker i serves metrics on METRICS_PORT + i.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+
+from telegram import Bot, Update
+from telegram.ext import Application, Updater
+
+import async_db as db
+import callbacks
+import database
+from approvals import configure_engine
+from bot import ALLOWED_UPDATES, build_application, post_init, post_shutdown, webhook_settings
+from config import (
+    BOT_TOKEN, UPDATE_MODE, APPROVAL_RATE, APPROVAL_BURST, RATE_LIMIT_GLOBAL,
+    RATE_LIMIT_GLOBAL_BURST, SHARD_QUEUE_SIZE, SHARD_INDEX_REFRESH, SHARD_FLUSH_POLL,
+    SHARD_FLUSH_TIMEOUT
+)
+from ingest import pending_writer, set_chat_flusher
+from ratelimit import RateGovernor, SharedTokenBucket, shared_bucket_state
+from recorder import recorder
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, count):
+    """Index of the worker that handles a chat"""
+    return chat_id % count
+
+
+# Worker that runs approval jobs, maintenance and retries
+JOB_SHARD = 0
+
+# Buttons that start or cancel approval jobs, which are all routed to JOB_SHARD
+JOB_ROUTES = {callbacks.ACCEPT, callbacks.CANCEL_JOB}
+
+
+def update_chat_id(update):
+    """Chat an update is routed by (the user for updates without a chat)"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+def update_shard(update, count):
+    """Index of the worker that handles an update"""
+    query = update.callback_query
+    if query is not None and callbacks.router.code(query.data) in JOB_ROUTES:
+        return JOB_SHARD
+    return shard_of(update_chat_id(update), count)
+
+
+class Shard:
+    """Position of a worker process, stored in application.bot_data["shard"]"""
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    @property
+    def runs_jobs(self):
+        """True in the worker that runs approval jobs, maintenance and retries"""
+        return self.index == JOB_SHARD
+
+
+def pending_flush_state(context, count):
+    """Shared memory for PendingFlushes: (requested, done) counters per worker"""
+    return context.Array('q', count), context.Array('q', count)
+
+
+class PendingFlushes:
+    """Flushes of a worker's pending writer, asked for by another worker
+
+    The asking worker bumps the owner's `requested` counter; the owner polls
+    it, flushes everything buffered so far and copies the value to `done`.
+    """
+
+    def __init__(self, shard, state):
+        self.shard = shard
+        self.requested, self.done = state
+
+    async def flush(self, chat_id):
+        """Flush the pending writer of the worker that owns chat_id; False on timeout"""
+        owner = shard_of(chat_id, self.shard.count)
+        if owner == self.shard.index:
+            return await pending_writer.flush()
+        with self.requested.get_lock():
+            self.requested[owner] += 1
+            ticket = self.requested[owner]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SHARD_FLUSH_TIMEOUT
+        while self.done[owner] < ticket:
+            if loop.time() >= deadline:
+                logger.warning("Worker %d did not flush its pending requests in time", owner)
+                return False
+            await asyncio.sleep(SHARD_FLUSH_POLL)
+        return True
+
+    async def serve(self):
+        """Flush this worker's pending writer whenever another worker asks"""
+        index = self.shard.index
+        while True:
+            await asyncio.sleep(SHARD_FLUSH_POLL)
+            ticket = self.requested[index]
+            if ticket > self.done[index]:
+                await pending_writer.flush()
+                self.done[index] = ticket
+
+
+def run(workers):
+    """Start `workers` worker processes and feed them updates until SIGINT/SIGTERM"""
+    # Workers open their own connections; the ingress needs none
+    database.close_connection()
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+    budgets = (shared_bucket_state(context, RATE_LIMIT_GLOBAL_BURST),
+               shared_bucket_state(context, APPROVAL_BURST))
+    flushes = pending_flush_state(context, workers)
+    processes = [
+        context.Process(target=_worker, args=(index, workers, queues[index], budgets, flushes),
+                        name=f"shard-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(_ingress(queues, processes))
+    finally:
+        for process in processes:
+            process.join()
+
+
+async def _ingress(queues, processes):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    updates = asyncio.Queue()
+    updater = Updater(Bot(BOT_TOKEN), updates)
+    async with updater:
+        if UPDATE_MODE == "webhook":
+            await updater.start_webhook(**webhook_settings())
+        else:
+            await updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        logger.info("Ingress started, routing updates to %d workers", len(queues))
+
+        forwarder = asyncio.create_task(_forward(updates, queues))
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                dead = [process.name for process in processes if not process.is_alive()]
+                if dead:
+                    logger.error("Worker %s exited, shutting down", ", ".join(dead))
+                    stop.set()
+
+        # Stop receiving, hand over what was already received, then stop the workers
+        await updater.stop()
+        forwarder.cancel()
+        await asyncio.gather(forwarder, return_exceptions=True)
+        while not updates.empty():
+            await _put(queues, updates.get_nowait())
+    recorder.close()
+    for worker_queue in queues:
+        worker_queue.put(None)
+
+
+async def _forward(updates, queues):
+    while True:
+        await _put(queues, await updates.get())
+
+
+async def _put(queues, update):
+    if recorder.enabled:
+        recorder.write(update)
+    worker_queue = queues[update_shard(update, len(queues))]
+    data = update.to_dict()
+    try:
+        worker_queue.put_nowait(data)
+    except queue.Full:
+        # Back pressure: wait for the worker without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, worker_queue.put, data)
+
+
+def _worker(index, count, updates, budgets, flushes):
+    # The ingress process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    get_storage().open()
+    asyncio.run(_run_worker(Shard(index, count), updates, budgets, flushes))
+
+
+async def _run_worker(shard, updates, budgets, flush_state):
+    global_state, approval_state = budgets
+    rate_limiter = RateGovernor(global_bucket=SharedTokenBucket(
+        RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL_BURST, global_state))
+    application = build_application(Application.builder().token(BOT_TOKEN).updater(None),
+                                    rate_limiter=rate_limiter, record=False)
+    application.bot_data["shard"] = shard
+    configure_engine(application.bot, bucket=SharedTokenBucket(
+        APPROVAL_RATE, APPROVAL_BURST, approval_state))
+    flushes = PendingFlushes(shard, flush_state)
+    set_chat_flusher(flushes.flush)
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    refresher = asyncio.create_task(_refresh_auto_accept_index())
+    flush_server = asyncio.create_task(flushes.serve())
+    logger.info("Worker %d/%d started", shard.index, shard.count)
+
+    loop = asyncio.get_running_loop()
+    try:
+        while (data := await loop.run_in_executor(None, updates.get)) is not None:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        refresher.cancel()
+        flush_server.cancel()
+        # Same order as run_polling: process queued updates, shut down, then flush and close
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+async def _refresh_auto_accept_index():
+    while True:
+        await asyncio.sleep(SHARD_INDEX_REFRESH)
+        try:
+            await db.refresh_auto_accept_index()
+        except Exception:
+            logger.exception("Reloading the auto accept index failed")
@@ -0,0 +1,196 @@
+"""
+Storage backends for users, channels and pending join requests.
+
+async_db sends these queries to the configured backend (STORAGE_BACKEND):
+
+    "sqlite"  SQLiteStorage, the database.py tables in DB_PATH
+    "memory"  memory_storage.MemoryStorage, plain Python structures persisted
+              by periodic snapshots and an append-only log
+
+Approval jobs and the retry queue stay in the SQLite database with either
+backend. Backends are only called from the DB thread (async_db), except
+is_auto_accept, which must be a cheap in-memory lookup.
+"""
+
+import os
+from abc import ABC, abstractmethod
+
+import database
+from config import STORAGE_BACKEND, MEMORY_SNAPSHOT_PATH
+
+
+class Storage(ABC):
+    """Interface of a storage backend; rows are returned as dicts shaped like the SQLite rows"""
+
+    @abstractmethod
+    def open(self):
+        """Load or create the stored data"""
+
+    @abstractmethod
+    def close(self):
+        """Persist what is needed and release files"""
+
+    # Users
+
+    @abstractmethod
+    def add_user(self, user_id, username, first_name):
+        ...
+
+    # Channels
+
+    @abstractmethod
+    def add_channel(self, user_id, chat_id, title, chat_type):
+        """Add a channel for a user; False if the user already has it"""
+
+    @abstractmethod
+    def get_user_channels(self, user_id, limit=-1, offset=0):
+        """A user's channels in the order they were added, with 'pending_count'"""
+
+    @abstractmethod
+    def get_channel(self, user_id, chat_id):
+        """One channel with 'pending_count', or None"""
+
+    @abstractmethod
+    def delete_channel(self, user_id, chat_id):
+        ...
+
+    @abstractmethod
+    def toggle_auto_accept(self, user_id, chat_id):
+        """Flip auto accept; returns the new value (0 or 1)"""
+
+    @abstractmethod
+    def get_auto_accept_channels(self):
+        ...
+
+    @abstractmethod
+    def is_auto_accept(self, chat_id):
+        """True if any owner enabled auto accept for the chat (no I/O)"""
+
+    @abstractmethod
+    def refresh_auto_accept_index(self):
+        """Pick up auto accept changes made by other processes; True if anything was reloaded"""
+
+    # Pending requests, oldest first; a repeated request moves to the end
+
+    @abstractmethod
+    def add_pending_request(self, chat_id, user_id, first_name, username):
+        ...
+
+    @abstractmethod
+    def add_pending_requests(self, rows):
+        """rows: iterable of (chat_id, user_id, first_name, username)"""
+
+    @abstractmethod
+    def get_pending_requests(self, chat_id, limit=None):
+        ...
+
+    @abstractmethod
+    def get_pending_page(self, chat_id, limit, after=None):
+        """The next `limit` requests after the row with (created_at, id) == after"""
+
+    @abstractmethod
+    def delete_pending_request(self, chat_id, user_id):
+        ...
+
+    @abstractmethod
+    def delete_pending_requests(self, chat_id, user_ids):
+        ...
+
+    @abstractmethod
+    def get_pending_count(self, chat_id):
+        ...
+
+    @abstractmethod
+    def expire_pending_requests(self, max_age_seconds, limit):
+        """Delete up to `limit` requests older than max_age_seconds; returns the number deleted"""
+
+
+class SQLiteStorage(Storage):
+    """The tables of database.py (functions are looked up per call, so bench.py can time them)"""
+
+    def open(self):
+        database.init_db()
+        database.load_auto_accept_index()
+
+    def close(self):
+        database.close_connection()
+
+    def add_user(self, user_id, username, first_name):
+        return database.add_user(user_id, username, first_name)
+
+    def add_channel(self, user_id, chat_id, title, chat_type):
+        return database.add_channel(user_id, chat_id, title, chat_type)
+
+    def get_user_channels(self, user_id, limit=-1, offset=0):
+        return database.get_user_channels(user_id, limit, offset)
+
+    def get_channel(self, user_id, chat_id):
+        return database.get_channel(user_id, chat_id)
+
+    def delete_channel(self, user_id, chat_id):
+        return database.delete_channel(user_id, chat_id)
+
+    def toggle_auto_accept(self, user_id, chat_id):
+        return database.toggle_auto_accept(user_id, chat_id)
+
+    def get_auto_accept_channels(self):
+        return database.get_auto_accept_channels()
+
+    def is_auto_accept(self, chat_id):
+        return database.is_auto_accept(chat_id)
+
+    def refresh_auto_accept_index(self):
+        return database.refresh_auto_accept_index()
+
+    def add_pending_request(self, chat_id, user_id, first_name, username):
+        return database.add_pending_request(chat_id, user_id, first_name, username)
+
+    def add_pending_requests(self, rows):
+        return database.add_pending_requests(rows)
+
+    def get_pending_requests(self, chat_id, limit=None):
+        return database.get_pending_requests(chat_id, limit)
+
+    def get_pending_page(self, chat_id, limit, after=None):
+        return database.get_pending_page(chat_id, limit, after)
+
+    def delete_pending_request(self, chat_id, user_id):
+        return database.delete_pending_request(chat_id, user_id)
+
+    def delete_pending_requests(self, chat_id, user_ids):
+        return database.delete_pending_requests(chat_id, user_ids)
+
+    def get_pending_count(self, chat_id):
+        return database.get_pending_count(chat_id)
+
+    def expire_pending_requests(self, max_age_seconds, limit):
+        return database.expire_pending_requests(max_age_seconds, limit)
+
+
+def create_storage(backend=STORAGE_BACKEND):
+    """A new, not yet opened, storage backend by name"""
+    if backend == "sqlite":
+        return SQLiteStorage()
+    if backend == "memory":
+        from memory_storage import MemoryStorage
+        path = MEMORY_SNAPSHOT_PATH or os.path.splitext(database.DB_PATH)[0] + '.snapshot.json'
+        return MemoryStorage(path)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r} (expected 'sqlite' or 'memory')")
+
+
+_storage = None
+
+
+def get_storage():
+    """The backend in use (created from config on first use)"""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
+
+
+def set_storage(storage):
+    """Use another backend, e.g. a MemoryStorage in benchmarks; returns it"""
+    global _storage
+    _storage = storage
+    return storage
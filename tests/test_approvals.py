@@ -0,0 +1,107 @@
+import asyncio
+
+from telegram.error import Forbidden, NetworkError
+
+import approvals
+import cache
+import database
+import harness
+import retries
+from approvals import ApprovalStats
+from retries import retry_queue
+from storage import get_storage
+
+
+class FakeEngine:
+    """approve_many that fails the given users with a transient error"""
+
+    def __init__(self, failing):
+        self.failing = failing
+
+    async def approve_many(self, chat_id, user_ids, failures=None):
+        stats = ApprovalStats()
+        for user_id in user_ids:
+            if user_id in self.failing:
+                stats.failed += 1
+                failures[user_id] = NetworkError("timed out")
+            else:
+                stats.accepted += 1
+        return stats
+
+
+def pending_users(chat_id):
+    return sorted(row['user_id'] for row in database.get_pending_requests(chat_id))
+
+
+def approve_batch(chat_id, failing):
+    async def scenario():
+        retry_queue.start_writer()
+        try:
+            requests = database.get_pending_requests(chat_id)
+            return await approvals._approve_batch(FakeEngine(failing), chat_id, requests)
+        finally:
+            await retry_queue.stop()
+    return asyncio.run(scenario())
+
+
+def test_deferred_approvals_move_to_retry_queue(tmp_path):
+    harness.use_scratch_db(str(tmp_path / "bot_data.db"))
+    database.add_pending_requests([(-100, user_id, "x", None) for user_id in (1, 2, 3)])
+
+    stats = approve_batch(-100, failing={2})
+
+    assert (stats.accepted, stats.failed, stats.deferred) == (2, 0, 1)
+    assert pending_users(-100) == []
+    retried = database.get_due_approval_retries(float("inf"), 10)
+    assert [row['user_id'] for row in retried] == [2]
+
+
+def test_failed_deferral_write_keeps_requests_pending(tmp_path, monkeypatch):
+    harness.use_scratch_db(str(tmp_path / "bot_data.db"))
+    database.add_pending_requests([(-100, user_id, "x", None) for user_id in (1, 2, 3)])
+
+    async def broken(rows):
+        raise RuntimeError("disk I/O error")
+
+    monkeypatch.setattr(retries.db, "schedule_approval_retries", broken)
+    stats = approve_batch(-100, failing={2, 3})
+
+    assert (stats.accepted, stats.deferred) == (1, 0)
+    assert pending_users(-100) == [2, 3]
+
+
+def test_failed_pending_write_keeps_exhausted_retries(tmp_path, monkeypatch):
+    harness.use_scratch_db(str(tmp_path / "bot_data.db"))
+    database.schedule_approval_retries([(-100, 2, "x", None, 99, 0, "NetworkError")])
+    monkeypatch.setattr(get_storage(), "add_pending_requests", lambda rows: False)
+
+    async def scenario():
+        retry_queue.start_writer()
+        try:
+            await retry_queue.run_once(FakeEngine(failing={2}))
+        finally:
+            await retry_queue.stop()
+    asyncio.run(scenario())
+
+    assert pending_users(-100) == []
+    retried = database.get_due_approval_retries(float("inf"), 10)
+    assert [row['user_id'] for row in retried] == [2]
+
+
+class RefusingBot:
+    """approve_chat_join_request that fails because the bot was demoted"""
+
+    async def approve_chat_join_request(self, chat_id, user_id):
+        raise Forbidden("bot is not a member of the channel chat")
+
+
+def test_permission_error_invalidates_cached_admin_status():
+    cache.admin_cache.set((-100, 1), True)
+    cache.admin_cache.set((-200, 1), True)
+    engine = approvals.ApprovalEngine(RefusingBot(), rate=1000, burst=1000)
+
+    stats = asyncio.run(engine.approve_many(-100, [1, 2, 3]))
+
+    assert stats.failed == 3
+    assert cache.admin_cache.get((-100, 1)) is cache.MISSING
+    assert cache.admin_cache.get((-200, 1)) is True
@@ -0,0 +1,45 @@
+import pytest
+
+import callbacks
+import handlers
+from callbacks import router
+
+CHAT_ID = -1001234567890
+
+
+@pytest.mark.parametrize("data, handler, args", [
+    ("add_channel", handlers.show_add_help, []),
+    ("add_group", handlers.show_add_help, []),
+    ("my_channels", handlers.show_my_channels, []),
+    ("accept_requests", handlers.show_accept_channels, []),
+    (f"choose_{CHAT_ID}", handlers.show_accept_menu, [CHAT_ID]),
+    (f"manage_{CHAT_ID}", handlers.show_channel_actions, [CHAT_ID]),
+    (f"channel_accept_{CHAT_ID}", handlers.show_accept_menu, [CHAT_ID]),
+    (f"auto_accept_{CHAT_ID}", handlers.toggle_auto_accept, [CHAT_ID]),
+    (f"delete_channel_{CHAT_ID}", handlers.delete_channel, [CHAT_ID]),
+    (f"accept_100_{CHAT_ID}", handlers.start_accept_job, [100, CHAT_ID]),
+    (f"accept_all_{CHAT_ID}", handlers.start_accept_job, [None, CHAT_ID]),
+    ("back_main", handlers.back_to_main, []),
+    (f"claim_{CHAT_ID}", handlers.handle_claim_callback, [CHAT_ID]),
+])
+def test_legacy_payloads_map_to_routes(data, handler, args):
+    route, parsed = router.parse(data)
+    assert route.handler is handler
+    assert parsed == args
+
+
+def test_encoded_payloads_round_trip():
+    route, parsed = router.parse(callbacks.encode(callbacks.ACCEPT, "all", CHAT_ID))
+    assert route.handler is handlers.start_accept_job
+    assert parsed == [None, CHAT_ID]
+    route, parsed = router.parse(callbacks.encode(callbacks.MY_CHANNELS, 2))
+    assert (route.handler, parsed) == (handlers.show_my_channels, [2])
+
+
+@pytest.mark.parametrize("data", [
+    callbacks.ACCEPT, callbacks.encode(callbacks.ACCEPT, 10), callbacks.CHOOSE,
+    callbacks.CANCEL_JOB, "manage", "accept_all", f"{callbacks.MANAGE}:{CHAT_ID}:1",
+    f"{callbacks.MANAGE}:x", "unknown",
+])
+def test_malformed_payloads_match_no_route(data):
+    assert router.parse(data) == (None, None)
@@ -0,0 +1,100 @@
+import os
+
+from memory_storage import MemoryStorage
+
+OWNER_ID = 1
+CHAT_ID = -100
+OTHER_CHAT_ID = -200
+
+
+def open_storage(path):
+    storage = MemoryStorage(str(path), snapshot_interval=float("inf"))
+    storage.open()
+    return storage
+
+
+def crash(storage):
+    """Stop without the snapshot close() would write, leaving only the log"""
+    storage._log.close()
+    storage._log = None
+
+
+def pending_users(storage, chat_id):
+    return [row['user_id'] for row in storage.get_pending_requests(chat_id)]
+
+
+def fill(storage):
+    storage.add_user(OWNER_ID, "owner", "Owner")
+    storage.add_channel(OWNER_ID, CHAT_ID, "Channel", "channel")
+    storage.add_pending_requests([(CHAT_ID, user_id, "x", None) for user_id in (10, 11, 12)])
+    storage.add_pending_requests([(OTHER_CHAT_ID, 20, "x", None)])
+
+
+def test_log_is_replayed_on_top_of_the_snapshot(tmp_path):
+    storage = open_storage(tmp_path / "memory.json")
+    fill(storage)
+    storage.snapshot()
+    storage.delete_pending_requests(CHAT_ID, [11])
+    storage.add_pending_requests([(CHAT_ID, 13, "x", None)])
+    storage.toggle_auto_accept(OWNER_ID, CHAT_ID)
+    crash(storage)
+
+    storage = open_storage(tmp_path / "memory.json")
+    assert pending_users(storage, CHAT_ID) == [10, 12, 13]
+    assert pending_users(storage, OTHER_CHAT_ID) == [20]
+    assert storage.get_channel(OWNER_ID, CHAT_ID)['pending_count'] == 3
+    assert storage.is_auto_accept(CHAT_ID)
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    storage = open_storage(tmp_path / "memory.json")
+    fill(storage)
+    crash(storage)
+    with open(storage.log_path, "a", encoding="utf-8") as f:
+        f.write('["pending",[[-100,99,')   # crash in the middle of a write
+
+    storage = open_storage(tmp_path / "memory.json")
+    assert pending_users(storage, CHAT_ID) == [10, 11, 12]
+    # The next entry must start on its own line, not continue the torn one
+    storage.add_pending_requests([(CHAT_ID, 13, "x", None)])
+    crash(storage)
+
+    storage = open_storage(tmp_path / "memory.json")
+    assert pending_users(storage, CHAT_ID) == [10, 11, 12, 13]
+
+
+def test_crash_before_log_truncation_replays_to_the_same_state(tmp_path):
+    storage = open_storage(tmp_path / "memory.json")
+    fill(storage)
+    storage.delete_pending_requests(CHAT_ID, [10])
+    storage.add_pending_requests([(CHAT_ID, 10, "x", None)])   # asked again
+    storage.delete_pending_requests(OTHER_CHAT_ID, [20])
+    with open(storage.log_path, encoding="utf-8") as f:
+        log = f.read()
+    expected = {chat_id: pending_users(storage, chat_id) for chat_id in (CHAT_ID, OTHER_CHAT_ID)}
+
+    # The snapshot replaced the old one, but the log was not emptied yet
+    storage.snapshot()
+    crash(storage)
+    with open(storage.log_path, "w", encoding="utf-8") as f:
+        f.write(log)
+
+    storage = open_storage(tmp_path / "memory.json")
+    assert os.path.getsize(storage.log_path) > 0
+    assert {chat_id: pending_users(storage, chat_id) for chat_id in expected} == expected
+    assert storage.get_pending_count(CHAT_ID) == 3
+    assert storage.get_pending_count(OTHER_CHAT_ID) == 0
+    assert storage.get_channel(OWNER_ID, CHAT_ID)['pending_count'] == 3
+    assert len(storage.get_user_channels(OWNER_ID)) == 1
+
+
+def test_deleting_a_missing_channel_is_not_logged(tmp_path):
+    storage = open_storage(tmp_path / "memory.json")
+    fill(storage)
+    storage.delete_channel(OWNER_ID, CHAT_ID)
+    size = os.path.getsize(storage.log_path)
+
+    storage.delete_channel(OWNER_ID, CHAT_ID)
+    storage.delete_channel(OWNER_ID + 1, OTHER_CHAT_ID)
+
+    assert os.path.getsize(storage.log_path) == size
@@ -0,0 +1,34 @@
+import threading
+
+from metrics import Counter, Histogram, Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("h", "help", ["name"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, "a")
+    lines = list(histogram.render())
+    assert 'h_bucket{name="a",le="0.1"} 1' in lines
+    assert 'h_bucket{name="a",le="1.0"} 2' in lines
+    assert 'h_bucket{name="a",le="+Inf"} 3' in lines
+    assert 'h_count{name="a"} 3' in lines
+
+
+def test_render_while_another_thread_adds_series():
+    registry = Registry()
+    histogram = registry.register(Histogram("h", "help", ["name"]))
+    counter = registry.register(Counter("c", "help", ["name"]))
+
+    def record():
+        for i in range(20000):
+            histogram.observe(0.01, str(i))
+            counter.inc(str(i))
+
+    thread = threading.Thread(target=record)
+    thread.start()
+    try:
+        while thread.is_alive():
+            registry.render()   # raised "dictionary changed size during iteration"
+    finally:
+        thread.join()
+    assert 'c{name="19999"} 1' in registry.render()
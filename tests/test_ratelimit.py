@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+import time
+
+from telegram.error import RetryAfter
+
+from ratelimit import FAIL_FAST, RateGovernor, TokenBucket, retry_after_seconds
+
+
+def make_governor():
+    return RateGovernor(global_rate=1000, global_burst=1000, private_chat_rate=1000,
+                        group_chat_rate=1000, chat_burst=1000, max_retries=1)
+
+
+def flood_once(seconds):
+    """API call that answers the first attempt with RetryAfter"""
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(datetime.timedelta(seconds=seconds))
+        return True
+
+    return callback, calls
+
+
+def test_chat_flood_wait_only_pauses_that_chat():
+    async def scenario():
+        governor = make_governor()
+        flooded, flooded_calls = flood_once(0.3)
+        started = time.monotonic()
+        send = asyncio.create_task(governor.process_request(
+            flooded, (), {}, "sendMessage", {"chat_id": -1}, None))
+        await asyncio.sleep(0.05)
+
+        async def call():
+            return True
+
+        await governor.process_request(call, (), {}, "approveChatJoinRequest", {"chat_id": -2}, None)
+        await governor.process_request(call, (), {}, "sendMessage", {"chat_id": -3}, None)
+        others_done = time.monotonic() - started
+        await send
+        return others_done, flooded_calls[1] - flooded_calls[0]
+
+    others_done, retried_after = asyncio.run(scenario())
+    assert others_done < 0.2
+    assert retried_after >= 0.3
+
+
+def test_global_flood_wait_pauses_every_call():
+    async def scenario():
+        governor = make_governor()
+        flooded, _ = flood_once(0.3)
+        started = time.monotonic()
+        approve = asyncio.create_task(governor.process_request(
+            flooded, (), {}, "approveChatJoinRequest", {"chat_id": -1}, None))
+        await asyncio.sleep(0.05)
+
+        async def call():
+            return True
+
+        await governor.process_request(call, (), {}, "sendMessage", {"chat_id": -3}, None)
+        waited = time.monotonic() - started
+        await approve
+        return waited
+
+    assert asyncio.run(scenario()) >= 0.3
+
+
+def test_fail_fast_raises_instead_of_waiting():
+    async def scenario():
+        governor = make_governor()
+        flooded, calls = flood_once(5)
+        started = time.monotonic()
+        try:
+            await governor.process_request(
+                flooded, (), {}, "approveChatJoinRequest", {"chat_id": -1}, FAIL_FAST)
+        except RetryAfter:
+            pass
+        else:
+            raise AssertionError("RetryAfter was not raised")
+
+        async def call():
+            return True
+
+        # The pause still holds back the next fail-fast call, without calling the API
+        try:
+            await governor.process_request(
+                call, (), {}, "approveChatJoinRequest", {"chat_id": -1}, FAIL_FAST)
+        except RetryAfter as e:
+            retry_after = retry_after_seconds(e)
+        return time.monotonic() - started, len(calls), retry_after
+
+    elapsed, calls, retry_after = asyncio.run(scenario())
+    assert elapsed < 0.2
+    assert calls == 1
+    assert retry_after == 5
+
+
+def test_token_bucket_rate():
+    async def scenario():
+        bucket = TokenBucket(100, 10)
+        started = time.monotonic()
+        for _ in range(30):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 10 from the burst, the other 20 at 100/s
+    assert 0.15 < asyncio.run(scenario()) < 0.5
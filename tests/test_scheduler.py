@@ -0,0 +1,123 @@
+import asyncio
+
+from scheduler import FairScheduler
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def make_scheduler(jobs, slots=1):
+    """A scheduler with one registered job per (job_id, owner_id)"""
+    scheduler = FairScheduler(rate=10, quantum=5, slots=slots, max_jobs_per_owner=3, weights={})
+    for job_id, owner_id in jobs:
+        scheduler.register(job_id, owner_id, 100)
+    return scheduler
+
+
+async def take_turn(scheduler, job_id, wanted=5):
+    async with scheduler.turn(job_id, wanted) as granted:
+        return granted
+
+
+def test_turns_alternate_between_owners():
+    async def scenario():
+        scheduler = make_scheduler([(1, 1), (2, 1), (3, 2)])
+        order = []
+
+        async def job(job_id):
+            for _ in range(2):
+                async with scheduler.turn(job_id, 5):
+                    order.append(job_id)
+                    await asyncio.sleep(0)
+
+        await asyncio.gather(job(1), job(2), job(3))
+        return order
+
+    order = run(scenario())
+    # Owner 2's single job gets a turn between owner 1's jobs, not after both
+    assert order.index(3) < 2
+
+
+def test_cancel_while_slot_is_handed_over():
+    async def scenario():
+        scheduler = make_scheduler([(1, 1), (2, 2), (3, 3)])
+        release = asyncio.Event()
+        victim = None
+
+        async def holder():
+            async with scheduler.turn(1, 5):
+                await release.wait()
+                # Cancelled in the same step the slot is given up, before the
+                # victim's _acquire has run its cleanup
+                victim.cancel()
+
+        holding = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        victim = asyncio.create_task(take_turn(scheduler, 2))
+        other = asyncio.create_task(take_turn(scheduler, 3))
+        await asyncio.sleep(0)
+        release.set()
+
+        await holding  # must not raise InvalidStateError
+        granted = await asyncio.wait_for(other, 1)
+        assert victim.cancelled()
+        return scheduler, granted
+
+    scheduler, granted = run(scenario())
+    assert granted == 5
+    assert not scheduler._running
+    assert scheduler.waiting_jobs == 0
+
+
+def test_cancel_after_grant_frees_the_slot():
+    async def scenario():
+        scheduler = make_scheduler([(1, 1), (2, 2), (3, 3)])
+        release = asyncio.Event()
+        victim = None
+
+        async def holder():
+            async with scheduler.turn(1, 5):
+                await release.wait()
+            # Job 2 has just been granted the slot but has not run yet
+            victim.cancel()
+
+        holding = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        victim = asyncio.create_task(take_turn(scheduler, 2))
+        other = asyncio.create_task(take_turn(scheduler, 3))
+        await asyncio.sleep(0)
+        release.set()
+        await holding
+        granted = await asyncio.wait_for(other, 1)
+        return scheduler, granted, victim
+
+    scheduler, granted, victim = run(scenario())
+    assert victim.cancelled()
+    assert granted == 5
+    assert not scheduler._running
+
+
+def test_unregister_drops_waiting_job():
+    async def scenario():
+        scheduler = make_scheduler([(1, 1), (2, 2)])
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.turn(1, 5):
+                await release.wait()
+
+        holding = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(take_turn(scheduler, 2))
+        await asyncio.sleep(0)
+        assert scheduler.status(2)[0] == 1
+        waiting.cancel()
+        scheduler.unregister(2)
+        release.set()
+        await holding
+        return scheduler
+
+    scheduler = run(scenario())
+    assert scheduler.status(2) == (None, None)
+    assert scheduler.waiting_jobs == 0
@@ -0,0 +1,40 @@
+import asyncio
+import multiprocessing
+
+import database
+import harness
+import sharding
+from ingest import pending_writer
+from sharding import PendingFlushes, Shard, pending_flush_state
+
+CHAT_ID = -99   # owned by worker 1 of 2
+
+
+def test_job_worker_flushes_the_owning_workers_buffer(tmp_path, monkeypatch):
+    harness.use_scratch_db(str(tmp_path / "bot_data.db"))
+    monkeypatch.setattr(pending_writer, "flush_interval", 60)
+    state = pending_flush_state(multiprocessing.get_context("spawn"), 2)
+    job_worker = PendingFlushes(Shard(0, 2), state)
+    owner = PendingFlushes(Shard(1, 2), state)
+
+    async def scenario():
+        pending_writer.start()
+        server = asyncio.create_task(owner.serve())
+        try:
+            await pending_writer.add(CHAT_ID, 1, "x", None)
+            assert database.get_pending_count(CHAT_ID) == 0
+            return await job_worker.flush(CHAT_ID)
+        finally:
+            server.cancel()
+            await pending_writer.stop()
+
+    assert asyncio.run(scenario())
+    assert database.get_pending_count(CHAT_ID) == 1
+
+
+def test_flush_times_out_when_the_owner_does_not_answer(monkeypatch):
+    monkeypatch.setattr(sharding, "SHARD_FLUSH_TIMEOUT", 0.1)
+    state = pending_flush_state(multiprocessing.get_context("spawn"), 2)
+    job_worker = PendingFlushes(Shard(0, 2), state)
+
+    assert asyncio.run(job_worker.flush(CHAT_ID)) is False
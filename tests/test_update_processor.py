@@ -0,0 +1,108 @@
+import asyncio
+
+from telegram import Update
+
+import harness
+from update_processor import KeyedUpdateProcessor
+
+OWNER_ID = 1
+CHAT_ID = -1001000000001
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def click(user_id, data="bm"):
+    return Update.de_json(harness.make_callback_query(user_id, data), None)
+
+
+def join_request(chat_id, user_id):
+    return Update.de_json(harness.make_join_request(chat_id, user_id), None)
+
+
+async def process_all(processor, updates, handle):
+    """Start one task per update in arrival order, like the Application does"""
+    tasks = [asyncio.create_task(processor.process_update(update, handle(name)))
+             for name, update in updates]
+    await asyncio.gather(*tasks)
+
+
+def test_same_key_runs_in_arrival_order():
+    async def scenario():
+        processor = KeyedUpdateProcessor(8)
+        order = []
+
+        async def handle(name):
+            order.append(("start", name))
+            # The first update takes longest, so a race would let the later ones pass it
+            await asyncio.sleep(0.01 if name == 0 else 0)
+            order.append(("end", name))
+
+        await process_all(processor, [(i, click(OWNER_ID)) for i in range(3)], handle)
+        return order
+
+    assert run(scenario()) == [(step, i) for i in range(3) for step in ("start", "end")]
+
+
+def test_different_keys_run_concurrently():
+    async def scenario():
+        processor = KeyedUpdateProcessor(8)
+        running = peak = 0
+
+        async def handle(name):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await process_all(processor, [(i, click(OWNER_ID + i)) for i in range(4)], handle)
+        return peak
+
+    assert run(scenario()) == 4
+
+
+def test_join_requests_do_not_serialize_a_channel():
+    async def scenario():
+        processor = KeyedUpdateProcessor(8)
+        running = peak = 0
+        order = []
+
+        async def handle(name):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01 if name == "first" else 0)
+            order.append(name)
+            running -= 1
+
+        updates = [(i, join_request(CHAT_ID, 100 + i)) for i in range(4)]
+        # A second request from the same user still waits for the first one
+        updates.insert(0, ("first", join_request(CHAT_ID, 99)))
+        updates.append(("again", join_request(CHAT_ID, 99)))
+        await process_all(processor, updates, handle)
+        return peak, order
+
+    peak, order = run(scenario())
+    assert peak > 1
+    assert order.index("first") < order.index("again")
+
+
+def test_pending_returns_to_zero():
+    async def scenario():
+        processor = KeyedUpdateProcessor(2)
+        seen = []
+
+        async def handle(name):
+            seen.append(processor.pending)
+            await asyncio.sleep(0)
+
+        updates = [(i, click(OWNER_ID + i % 3)) for i in range(10)]
+        await process_all(processor, updates, handle)
+        return processor, seen
+
+    processor, seen = run(scenario())
+    assert max(seen) > 1
+    assert processor.pending == 0
+    assert processor._tails == {}